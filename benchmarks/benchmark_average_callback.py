@@ -0,0 +1,50 @@
+""" Block statistics of the MockTACamera viewer for 574 pixels and 250 scans:
+the former scan by scan loop against the vectorized scan_statistics.
+"""
+import timeit
+import numpy as np
+from pymodaq_plugins_transient_absorption.daq_viewer_plugins.plugins_1D\
+    .daq_1Dviewer_MockTACamera import scan_statistics
+from pymodaq_plugins_transient_absorption.hardware.controller import \
+    MockTACamera
+
+
+def loop_statistics(raw_data, n_pix, acq_per_block, clear_reads):
+    sum_data = [np.zeros(n_pix) for _ in range(2)]
+    squares_data = [np.zeros(n_pix) for _ in range(2)]
+    valid_scans = acq_per_block - clear_reads
+    src_pos = clear_reads * n_pix * 2
+    for _ in range(valid_scans):
+        for i in range(2):
+            raw = raw_data[src_pos:src_pos + n_pix].astype(np.float64)
+            sum_data[i] += raw
+            squares_data[i] += raw**2
+            src_pos += n_pix
+    return [sum_data[i] / valid_scans for i in range(2)], \
+        [np.sqrt((valid_scans * squares_data[i] - sum_data[i]**2)
+                 / (valid_scans * (valid_scans - 1))) for i in range(2)]
+
+
+def benchmark_average_callback(n_pix=574, acq_per_block=250, clear_reads=4,
+                               repeat=5, number=20):
+    camera = MockTACamera(n_pixels=n_pix, scans_per_block=acq_per_block,
+                          seed=0)
+    raw_data = camera.calculate_block(0, 0, False, True, False)
+    scans = raw_data.reshape(acq_per_block, 2, n_pix)[clear_reads:]
+    candidates = {
+        'loop': lambda: loop_statistics(raw_data, n_pix, acq_per_block,
+                                        clear_reads),
+        'int64': lambda: scan_statistics(scans, np.int64),
+        'float64': lambda: scan_statistics(scans),
+        'float32': lambda: scan_statistics(scans, np.float32),
+        'median/MAD': lambda: scan_statistics(scans, robust=True),
+        }
+    return { name: min(timeit.repeat(function, repeat=repeat, number=number))
+             / number for name, function in candidates.items() }
+
+
+if __name__ == '__main__':
+    results = benchmark_average_callback()
+    for name, seconds in results.items():
+        print('%-10s %8.3f ms/block  %6.0f blocks/s'
+              % (name, seconds * 1000, 1 / seconds))
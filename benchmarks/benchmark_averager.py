@@ -0,0 +1,36 @@
+""" Compares the scan by scan and the block wise accumulation of Averager,
+and the exact integer accumulation of IntegerAverager, for a camera block
+of 250 scans with two 574 pixel cameras.
+"""
+import timeit
+import numpy as np
+from pymodaq_plugins_transient_absorption.averager import Averager, \
+    IntegerAverager
+
+
+def make_block(n_pix=574, n_scans=250):
+    rng = np.random.default_rng(0)
+    return rng.normal(30000, 100, 2 * n_pix * n_scans).astype(np.uint16)
+
+
+def benchmark_take_data(n_pix=574, n_scans=250, repeat=5, number=20):
+    data = make_block(n_pix, n_scans)
+    results = {}
+    for batched in [False, True]:
+        averager = Averager(start=0, end=n_pix, stride=2 * n_pix)
+        averager.batched = batched
+        times = timeit.repeat(lambda: averager.take_data(data), repeat=repeat,
+                              number=number)
+        results['block' if batched else 'scans'] = min(times) / number
+    averager = IntegerAverager(start=0, end=n_pix, stride=2 * n_pix)
+    times = timeit.repeat(lambda: averager.take_data(data), repeat=repeat,
+                          number=number)
+    results['integer'] = min(times) / number
+    return results
+
+
+if __name__ == '__main__':
+    results = benchmark_take_data()
+    for name, seconds in results.items():
+        print('%-7s %8.3f ms/block' % (name, seconds * 1000))
+    print('speed up %.1f' % (results['scans'] / results['block']))
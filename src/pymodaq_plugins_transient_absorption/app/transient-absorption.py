@@ -16,6 +16,13 @@ from pymodaq_gui.utils.main_window import MainWindow
 from pymodaq_plugins_stresing.daq_viewer_plugins.plugins_1D.daq_1Dviewer_Lscpcie\
     import DAQ_1DViewer_Lscpcie, MeasurementState
 from pymodaq_plugins_stresing.averager import Averager
+from pymodaq_plugins_transient_absorption.ta_writer import TAWriter
+from pymodaq_plugins_transient_absorption.delay_scan import DelaySchedule
+from pymodaq_plugins_transient_absorption.ta_matrix import TAMatrix
+from pymodaq_plugins_transient_absorption.ta_map_viewer import TAMapViewer
+from pymodaq_plugins_transient_absorption.display import DisplayCoalescer
+from pymodaq_plugins_transient_absorption.instrumentation import \
+    instrumentation
 
 
 RAW                   = 0
@@ -41,6 +48,14 @@ class StatusWidget(QWidget):
             self.add_entry("signal background", grid, row, "1.0")
         self.ref_back_scale_label, row = \
             self.add_entry("reference background", grid, row, "1.0")
+        self.render_time_label, row = \
+            self.add_entry("render time", grid, row, "0 ms")
+        self.dropped_label, row = \
+            self.add_entry("dropped frames", grid, row, "0")
+        # rows for the stages of the instrumentation, added when seen
+        self.timing_labels = {}
+        self.grid = grid
+        self.row = row
 
         layout.addLayout(grid)
         layout.addStretch()
@@ -62,6 +77,18 @@ class StatusWidget(QWidget):
         self.sig_back_scale_label.setText(str(signal))
         self.ref_back_scale_label.setText(str(reference))
 
+    def set_rendering(self, render_time, dropped):
+        self.render_time_label.setText("%.1f ms" % (render_time * 1000))
+        self.dropped_label.setText(str(dropped))
+
+    def set_timings(self, timings):
+        """Mean and 99th percentile per stage, see instrumentation"""
+        for name, (count, mean, median, p99) in timings.items():
+            if name not in self.timing_labels:
+                self.timing_labels[name], self.row = \
+                    self.add_entry(name, self.grid, self.row)
+            self.timing_labels[name].setText("%.0f / %.0f us" % (mean, p99))
+
 
 class TAApp(CustomApp):
 
@@ -79,9 +106,51 @@ class TAApp(CustomApp):
                'type': 'bool', 'value': True},
               {'name': 'probe_shutter', 'title': 'Probe Shutter Open',
                'type': 'bool', 'value': True},
+              {'name': 'record', 'title': 'Record to HDF5', 'type': 'group',
+               'tip': 'Stream darks and per scan point whitelight and TA '
+               'spectra to a file, one file per delay scan',
+               'children': [
+                   {'name': 'enabled', 'title': 'Record', 'type': 'bool',
+                    'value': False},
+                   {'name': 'raw', 'title': 'Raw Blocks', 'type': 'bool',
+                    'value': False,
+                    'tip': "Also the raw camera blocks the detector exports "
+                    "as 'raw', lzf compressed"},
+               ]},
+              {'name': 'delay_scan', 'title': 'Delay Scan', 'type': 'group',
+               'tip': 'One TA acquisition per delay of the schedule, the '
+               'stage is moved by hand',
+               'children': [
+                   {'name': 'mode', 'title': 'Schedule', 'type': 'list',
+                    'limits': DelaySchedule.modes},
+                   {'name': 'start', 'title': 'Start (ps)', 'type': 'float',
+                    'value': -1},
+                   {'name': 'end', 'title': 'End (ps)', 'type': 'float',
+                    'value': 1000},
+                   {'name': 'step', 'title': 'Linear Step (ps)',
+                    'type': 'float', 'value': 0.1, 'min': 0},
+                   {'name': 'linear_end', 'title': 'Linear End (ps)',
+                    'type': 'float', 'value': 1,
+                    'tip': 'Lin-log: start of the logarithmic part'},
+                   {'name': 'n_log', 'title': 'Log Delays', 'type': 'int',
+                    'value': 30, 'min': 1},
+                   {'name': 'n_delays', 'title': 'Delays', 'type': 'int',
+                    'value': 0, 'readonly': True},
+                   {'name': 'point', 'title': 'Point', 'type': 'int',
+                    'value': 0, 'min': 0,
+                    'tip': 'Index of the next delay, advanced after every TA '
+                    'acquisition'},
+                   {'name': 'delay', 'title': 'Stage Delay (ps)',
+                    'type': 'float', 'value': 0, 'readonly': True,
+                    'tip': 'Move the stage here before acquiring, recorded '
+                    'with the TA spectrum'},
+               ]},
               ]
 
     def __init__(self, parent: DockArea, plugin):
+        # viewers are repainted by a timer with the latest data only, see
+        # take_data
+        self.display = DisplayCoalescer()
         super().__init__(parent)
 
         self.plugin = plugin
@@ -110,8 +179,14 @@ class TAApp(CustomApp):
         self.measurement_mode = RAW
         self.measurement_state = MeasurementState.IDLE
         self.acquiring = False
+        self.writer = None
+        self.ta_result = None
+        self.whitelight_result = None
+        self.delays = np.zeros(0)
+        self.ta_matrix = None
         self.adjust_actions()
         self.adjust_parameters()
+        self.update_schedule()
 
     def setup_docks(self):
         # left column: essential parameters at top, small plots for dark and
@@ -159,6 +234,14 @@ class TAApp(CustomApp):
 
         whitelight_dock.addWidget(whitelight_widget)
 
+        # delay x pixel map of the scan with kinetics
+        map_dock = Dock('TA Map')
+        self.docks['map'] = \
+            self.dockarea.addDock(map_dock, "right",
+                                  self.docks['upper_spectrum'])
+        self.map_viewer = TAMapViewer()
+        map_dock.addWidget(self.map_viewer)
+
         # separate window with raw detector data
         self.daq_viewer_area = DockArea()
         self.detector = \
@@ -191,6 +274,11 @@ class TAApp(CustomApp):
         self.connect_action('show', self.show_detector)
         self.connect_action('acquire', self.start_acquiring)
         self.detector.grab_done_signal.connect(self.take_data)
+        self.display.rendered.connect(self.status_widget.set_rendering)
+        if instrumentation.enabled:
+            self.display.rendered.connect(
+                lambda *_: self.status_widget.set_timings(
+                    instrumentation.summary()))
 
     def setup_menu(self):
         file_menu = self.mainwindow.menuBar().addMenu('File')
@@ -218,6 +306,12 @@ class TAApp(CustomApp):
             self.detector.settings.child('detector_settings',
                                          'probe_open').setValue(param.value())
 
+        elif param.parent() is self.settings.child('delay_scan'):
+            if param.name() == 'point':
+                self.show_point()
+            elif param.name() not in ['n_delays', 'delay']:
+                self.update_schedule()
+
         self.adjust_operation()
         self.adjust_actions()
 
@@ -264,58 +358,92 @@ class TAApp(CustomApp):
         else:
             self.set_measurement_state(MeasurementState.RECORD_RAW_DATA)
 
+        point = self.settings.child('delay_scan', 'point').value()
+        if self.measurement_mode == TA and point >= len(self.delays):
+            self.set_measurement_state(MeasurementState.IDLE)
+            self.status_widget.set_state("no delay left in the schedule")
+            return
+
+        self.ta_result = None
+        # a scan keeps its file open from point to point
+        if self.settings.child('record', 'enabled').value() \
+           and self.writer is None \
+           and not self.open_writer():
+            self.set_measurement_state(MeasurementState.IDLE)
+            return
+
         self.acquiring = True
         self.detector.grab() # just go
-        return
 
-        # ignore this for now
-        result = QFileDialog.getSaveFileName(caption="Save Data", dir=".",
-                                             filter="*.csv")
-        if result is None:
-            return
+    def delay_schedule(self):
+        scan = self.settings.child('delay_scan')
+        return DelaySchedule(scan['mode'], scan['start'], scan['end'],
+                             scan['step'], scan['linear_end'], scan['n_log'])
 
-        # <<-- unclear: where does init of param values happen?
-        
-        #self.detector.settings.child('detector_settings', 'integration_time') \
-        #    .setValue(self._settings_tree.value("integration_time") * 1000)
-        
-        # determine number of significant digits according to
-        # error = sqrt(Naverage) assuming the best case with
-        # error(Naverage=1) is 1
-        n_average = \
-            self.detector.settings.child('main_settings', 'Naverage').value()
-        if n_average > 1:
-            self.format_string = \
-                '\t{val:.%df}' % (int(np.log10(np.sqrt(n_average))) + 1)
-        else:
-            self.format_string = '\t{val:.0f}'
-
-        # write wavelengths into file
-        self.data_file = open(result[0], "wt")
-        self.data_file.write('0\t0')
-        for wl in self.detector.controller.wavelengths:
-            self.data_file.write('\t%.1f' % wl)
-        self.data_file.write('\n')
-
-        # background (time delay -1) and reference (time delay -2) if needed
-        if self.measurement_mode >= WITH_BACKGROUND:
-            self.write_spectrum(-1, 0, self.background)
-            if self.measurement_mode == ABSORPTION:
-                self.write_spectrum(-2, 0, self.reference)
-
-        # calculate schedule, only linear for the moment, ignore lin-log
-        # QTimer counts in milliseconds
-        scan_end = self.settings['scan_end'] * 1000
-        linear_step = self.settings['linear_step'] * 1000
-        n_measurements = int(scan_end / linear_step) + 1
-        self.scheduled_measurement_times = \
-            np.linspace(0, scan_end, n_measurements) \
-            - self.settings['integration_time'] * 1000 - 20
-
-        # and go
-        self.current_time_index = 0
-        self.system_start_time = None
-        self.detector.snap()
+    def update_schedule(self):
+        """Takes the delays of the schedule, none if invalid, and starts
+        a new scan with its first point and an empty map.
+        """
+        try:
+            self.delays = self.delay_schedule().delays()
+        except ValueError:
+            self.delays = np.zeros(0)
+        if not self.acquiring:
+            self.close_writer()
+        if len(self.delays):
+            wavelengths = self.detector.controller.wavelengths
+            self.ta_matrix = TAMatrix(self.delays, len(wavelengths),
+                                      wavelengths)
+            self.map_viewer.set_matrix(self.ta_matrix)
+        scan = self.settings.child('delay_scan')
+        scan.child('n_delays').setValue(len(self.delays))
+        scan.child('point').setValue(0)
+        self.show_point()
+
+    def show_point(self):
+        """Shows the delay the stage has to be moved to, NaN once the
+        scan is complete.
+        """
+        point = self.settings.child('delay_scan', 'point').value()
+        self.settings.child('delay_scan', 'delay').setValue(
+            self.delays[point] if point < len(self.delays) else np.nan)
+
+    def finish_point(self):
+        """Records the TA of the finished acquisition at the delay of the
+        current point, shows it in its row of the map and advances to the
+        next point.
+        """
+        scan = self.settings.child('delay_scan')
+        point = scan['point']
+        if self.writer is not None:
+            self.writer.write_whitelight(self.whitelight_result)
+            self.writer.write_ta(scan['delay'], *self.ta_result)
+        self.ta_matrix.update(point, *self.ta_result)
+        self.map_viewer.update_rows([point])
+        scan.child('point').setValue(point + 1)
+        if point + 1 == len(self.delays):
+            self.ta_matrix.end_scan()
+
+    def open_writer(self):
+        """Asks for a file name and opens the HDF5 writer, False if
+        cancelled.
+        """
+        result = QFileDialog.getSaveFileName(caption="Record Data", dir=".",
+                                             filter="*.h5")
+        if result is None or not len(result[0]):
+            return False
+        wavelengths = self.detector.controller.wavelengths
+        mode = self.settings['measurement_mode']
+        self.writer = \
+            TAWriter(result[0], len(wavelengths), wavelengths,
+                     attributes={ 'measurement_mode': mode,
+                                  'averaging': self.settings['averaging'] })
+        return True
+
+    def close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
 
     def set_sĥutters(self, shutter_states):
         changed = False
@@ -357,82 +485,85 @@ class TAApp(CustomApp):
         scalings = data.get_data_from_name('scalings')
         if scalings is not None:
             self.status_widget.set_scaling(scalings[0][0], scalings[1][0])
+        raw = data.get_data_from_name('raw')
+        if raw is not None and self.writer is not None \
+           and self.settings.child('record', 'raw').value():
+            delay = self.settings.child('delay_scan', 'delay').value()
+            for block in raw:
+                self.writer.write_raw(delay, block)
 
         if self.measurement_state == MeasurementState.TAKE_BACKGROUND:
             mean = data.get_data_from_name('mean')
-            self.upper_spectrum_viewer.show_data(mean)
+            self.display.show(self.upper_spectrum_viewer, mean)
             rms = data.get_data_from_name('rms')
-            self.lower_spectrum_viewer.show_data(rms)
+            self.display.show(self.lower_spectrum_viewer, rms)
 
             background = data.get_data_from_name('background')
             if background is not None:
-                self.whitelight_viewer.show_data(background)
+                self.display.show(self.whitelight_viewer, background)
+                if self.writer is not None:
+                    self.writer.write_dark(background[0], background[-1])
                 print("got background ready")
                 self.set_measurement_state(MeasurementState.PREPARE_TA)
                 self.set_sĥutters({'pump': True, 'probe': True})
 
-            QApplication.processEvents()
             return
 
         if self.measurement_state == MeasurementState.RECORD_RAW_DATA \
            or self.measurement_state == MeasurementState.BACKGROUND_SUBTRACTED:
             mean = data.get_data_from_name('mean')
-            self.upper_spectrum_viewer.show_data(mean)
+            self.display.show(self.upper_spectrum_viewer, mean)
             rms = data.get_data_from_name('rms')
-            self.lower_spectrum_viewer.show_data(rms)
-            QApplication.processEvents()
+            self.display.show(self.lower_spectrum_viewer, rms)
             return
 
         if self.measurement_state == MeasurementState.DIFFERENCE:
             mean = data.get_data_from_name('mean')
-            self.upper_spectrum_viewer.show_data(mean)
+            self.display.show(self.upper_spectrum_viewer, mean)
             diff = data.get_data_from_name('difference')
-            self.lower_spectrum_viewer.show_data(diff)
-            QApplication.processEvents()
+            self.display.show(self.lower_spectrum_viewer, diff)
             return
 
         if self.measurement_state == MeasurementState.TA_DATA:
             ta = data.get_data_from_name('ta')
-            self.upper_spectrum_viewer.show_data(ta)
+            self.display.show(self.upper_spectrum_viewer, ta)
             rms = data.get_data_from_name('rms')
-            self.lower_spectrum_viewer.show_data(rms)
+            self.display.show(self.lower_spectrum_viewer, rms)
             whitelight = data.get_data_from_name('whitelight')
-            self.whitelight_viewer.show_data(whitelight)
-            QApplication.processEvents()
+            self.display.show(self.whitelight_viewer, whitelight)
+            self.current_data = ta[0]
+            # latest is the most averaged, recorded once at the end
+            self.ta_result = (ta[0], rms[0], samples)
+            self.whitelight_result = whitelight[0]
             return
 
-    def write_spectrum(self, t1, t2, spectrum):
-        """Writes a single spectrum to file.
-        The first two columns contain the system time at data retrieval
-        and the time stamp returned by the avaspec library, respectively.
-        """
-        self.data_file.write('%d\t%d'
-                             % (int(np.floor(t1 + 0.5)),
-                                int(np.floor(t2 + 0.5))))
-        if self.measurement_mode == ABSORPTION and t1 != -1:
-            # To save space in the data file, absorption data are stored as
-            # integer numbers. 1 LSB is 1µOD.
-            for value in spectrum:
-                self.data_file.write('\t%d' % (value * 1000 + 0.5))
-        else:
-            for value in spectrum:
-                self.data_file.write(self.format_string.format(val = value))
-        self.data_file.write('\n')
-
     def stop_acquiring(self):
         self.acquiring = False
         self.set_measurement_state(MeasurementState.IDLE)
         self.detector.stop_grab()
+        self.display.render() # last results
+        if self.ta_result is not None:
+            self.finish_point()
+        if self.measurement_mode != TA or \
+           self.settings.child('delay_scan', 'point').value() \
+           >= len(self.delays):
+            self.close_writer()
 
     def save_current_data(self):
         """Save dat currently displayed on the main plot."""
         if not hasattr(self, 'current_data'):
             return
         result = QFileDialog.getSaveFileName(caption="Save Data", dir=".",
-                                             filter="*.csv")
+                                             filter="*.csv;;*.h5")
         if result is None or not len(result[0]):
             return
         wavelengths = self.detector.controller.wavelengths
+        if result[0].endswith('.h5'):
+            with TAWriter(result[0], len(wavelengths), wavelengths) as writer:
+                writer.write_ta(self.settings.child('delay_scan',
+                                                    'delay').value(),
+                                self.current_data)
+            return
         with open(result[0], "wt") as csv_file:
             writer = csv.writer(csv_file, delimiter='\t',
                                 quotechar='|', quoting=csv.QUOTE_MINIMAL)
@@ -444,6 +575,8 @@ class TAApp(CustomApp):
         self.mainwindow.close()
 
     def clean_up(self):
+        self.display.stop()
+        self.close_writer()
         self.detector.quit_fun()
         QApplication.processEvents()
         settings = QSettings("chiphy", "transient-absorption")
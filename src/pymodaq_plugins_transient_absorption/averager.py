@@ -24,6 +24,16 @@ class Averager(AveragerData):
     CONTINUE = 1
     FAIL     = 2
 
+    # convergence criteria: compare consecutive blocks of min_samples scans
+    # and discard a block after a failed check, or keep accumulating and
+    # compare the estimate with the one of the previous check
+    BLOCKS  = 'blocks'
+    SLIDING = 'sliding'
+
+    # accumulate a whole block with one reduction instead of scan by scan
+    batched = True
+    convergence = BLOCKS
+
     def _init(self): # called from AveragerData.__post_init__
         self.n_pix = self.end - self.start
         self.sum_values = np.zeros(self.n_pix)
@@ -31,6 +41,7 @@ class Averager(AveragerData):
         self.changed = False
         self.samples = 0
         self.attempts = 0
+        self._checked_samples = 0
         self._prev_mean = None
         self._prev_rms = None
 
@@ -38,6 +49,7 @@ class Averager(AveragerData):
         self.sum_values.fill(0)
         self.sum_squared_values.fill(0)
         self.samples = 0
+        self._checked_samples = 0
 
     def reset(self):
         self.clear()
@@ -70,7 +82,24 @@ class Averager(AveragerData):
             self._average()
         return self._rms
 
-    def take_data(self, data):
+    def scans(self, data):
+        """Strided (scans, n_pix) view of the selected pixels of every scan
+        contained in data. No data are copied.
+        """
+        data = np.asarray(data)
+        n_scans = max(0, (len(data) - self.offset + self.stride - 1)
+                      // self.stride)
+        if n_scans == 0:
+            return data[:0].reshape(0, self.n_pix)
+        if self.offset + (n_scans - 1) * self.stride + self.end > len(data):
+            raise ValueError("Averager: incomplete scan at end of data")
+        item_stride = data.strides[0]
+        return np.lib.stride_tricks.as_strided(
+            data[self.offset + self.start:], shape=(n_scans, self.n_pix),
+            strides=(self.stride * item_stride, item_stride), writeable=False)
+
+    def accumulate_scans(self, data):
+        """Reference implementation, adds data scan by scan."""
         pos = self.offset
         while pos < len(data):
             selected_data = \
@@ -79,44 +108,208 @@ class Averager(AveragerData):
             self.sum_squared_values += selected_data**2
             pos += self.stride
             self.samples += 1
+
+    def accumulate_block(self, data):
+        """Adds all scans of data with one reduction for the whole block."""
+        block = self.scans(data).astype(np.float64, copy=False)
+        self.sum_values += block.sum(axis=0)
+        self.sum_squared_values += np.einsum('ij,ij->j', block, block)
+        self.samples += len(block)
+
+    def take_data(self, data):
+        if self.batched:
+            self.accumulate_block(data)
+        else:
+            self.accumulate_scans(data)
         self.changed = True
-    
-        if self.min_samples == 0 or self.samples < self.min_samples:
+
+        if self.min_samples == 0 \
+           or self.samples < self._checked_samples + self.min_samples:
             return self.CONTINUE
 
-        if self._prev_mean is not None:
-            diff_rms1 = \
-                sum(abs(self.rms - self._prev_rms) / self.rms) / self.n_pix
-            diff_rms2 = \
-                sum(abs(self.rms - self._prev_rms) / self._prev_rms) \
-                / self.n_pix
-            diff_mean = \
-                sum(abs(self.mean - self._prev_mean) / self.rms) \
-                / self.n_pix
-            if (self.limit_diff_rms > 0 and diff_rms1 > self.limit_diff_rms) \
-               or (self.limit_diff_rms > 0 and diff_rms2 > self.limit_diff_rms) \
-               or \
-               (self.limit_diff_mean > 0 and diff_mean > self.limit_diff_mean):
-                pass
-            else:
-                return self.SUCCESS
+        mean, rms = self.mean, self.rms
+        if self._prev_mean is not None and self.converged(mean, rms):
+            return self.SUCCESS
 
         self.attempts += 1
         if self.max_attempts > 0 and self.attempts >= self.max_attempts:
             return self.FAIL
 
-        if self.changed:
-            self._average()
-        self._prev_mean, self._prev_rms = self._mean, self._rms
-        self.clear()
+        self._prev_mean, self._prev_rms = mean, rms
+        if self.convergence == self.SLIDING:
+            self._checked_samples = self.samples
+        else:
+            self.clear()
         return self.CONTINUE
 
+    def converged(self, mean, rms):
+        """Mean relative change of rms and mean since the previous check
+        within the limits.
+        """
+        if self.limit_diff_rms > 0:
+            change_rms = abs(rms - self._prev_rms)
+            if np.mean(change_rms / rms) > self.limit_diff_rms \
+               or np.mean(change_rms / self._prev_rms) > self.limit_diff_rms:
+                return False
+        if self.limit_diff_mean > 0:
+            if np.mean(abs(mean - self._prev_mean) / rms) \
+               > self.limit_diff_mean:
+                return False
+        return True
+
+    def samples_to_check(self):
+        """Number of samples to take before the next convergence check,
+        None if the averager never checks."""
+        if self.min_samples == 0:
+            return None
+        return max(1, self._checked_samples + self.min_samples - self.samples)
+
+    def take_data_until_done(self, data, stop_on_fail=True):
+        """Takes scans of data like take_data called scan by scan would do
+        and stops at the scan for which the averager succeeds (or fails if
+        stop_on_fail is set). Scans are added in chunks ending at the
+        convergence checks.
+
+        Returns the result and the number of scans taken.
+        """
+        n_scans = len(self.scans(data))
+        taken = 0
+        result = self.CONTINUE
+        while taken < n_scans and result != self.SUCCESS \
+              and (result != self.FAIL or not stop_on_fail):
+            chunk = self.samples_to_check()
+            if chunk is None or chunk > n_scans - taken:
+                chunk = n_scans - taken
+            pos = taken * self.stride
+            result = self.take_data(
+                data[pos:pos + (chunk - 1) * self.stride + self.offset
+                     + self.end])
+            taken += chunk
+        return result, taken
+
+
+class WelfordAverager(Averager):
+    """Averager keeping running mean and sum of squared deviations (M2)
+    instead of plain sums. Blocks are merged with Chan's parallel formula,
+    single scans with Welford's update, which avoids the cancellation of
+    n * sum(x**2) - sum(x)**2 for large offsets and many samples.
+    """
+
+    def _init(self):
+        super()._init()
+        self.running_mean = np.zeros(self.n_pix)
+        self.m2 = np.zeros(self.n_pix)
+
+    def clear(self):
+        self.running_mean.fill(0)
+        self.m2.fill(0)
+        self.samples = 0
+        self._checked_samples = 0
+
+    @classmethod
+    def merge(cls, samples_a, mean_a, m2_a, samples_b, mean_b, m2_b):
+        samples = samples_a + samples_b
+        delta = mean_b - mean_a
+        mean = mean_a + delta * (samples_b / samples)
+        m2 = m2_a + m2_b + delta**2 * (samples_a * samples_b / samples)
+        return samples, mean, m2
+
+    def accumulate_scans(self, data):
+        pos = self.offset
+        while pos < len(data):
+            selected_data = \
+                data[pos + self.start:pos + self.end].astype(np.float64)
+            self.samples += 1
+            delta = selected_data - self.running_mean
+            self.running_mean += delta / self.samples
+            self.m2 += delta * (selected_data - self.running_mean)
+            pos += self.stride
+
+    def accumulate_block(self, data):
+        block = self.scans(data).astype(np.float64, copy=False)
+        if not len(block):
+            return
+        block_mean = block.mean(axis=0)
+        deviation = block - block_mean
+        block_m2 = np.einsum('ij,ij->j', deviation, deviation)
+        self.samples, self.running_mean[:], self.m2[:] = \
+            self.merge(self.samples, self.running_mean, self.m2,
+                       len(block), block_mean, block_m2)
+
+    def _average(self):
+        if self.samples < 2:
+            raise RuntimeError("Averager: need at least two samples")
+        self._mean = self.running_mean.copy()
+        self._rms = np.sqrt(self.m2 / (self.samples - 1))
+        self.changed = False
+
+
+class IntegerAverager(Averager):
+    """Exact accumulation of unsigned camera data of up to 16 bit: sums in
+    int64, sums of squares in uint64, which don't overflow before 2**32
+    scans. Conversion to float happens only when mean and rms are read.
+    """
+
+    def _init(self):
+        super()._init()
+        self.sum_values = np.zeros(self.n_pix, dtype=np.int64)
+        self.sum_squared_values = np.zeros(self.n_pix, dtype=np.uint64)
+
+    @classmethod
+    def check_type(cls, data):
+        if data.dtype.kind != 'u' or data.dtype.itemsize > 2:
+            raise ValueError("IntegerAverager: unsigned integer data of up "
+                             "to 16 bit required, got %s" % data.dtype)
+
+    @classmethod
+    def average(cls, sum_values, sum_squared_values, samples):
+        """Numerator of the variance evaluated exactly with Python integers,
+        rounded only once.
+        """
+        if samples < 2:
+            raise RuntimeError("Averager: need at least two samples")
+        sums = sum_values.astype(object)
+        numerator = samples * sum_squared_values.astype(object) - sums * sums
+        return sum_values / samples, \
+            np.sqrt(numerator.astype(np.float64) / (samples * (samples - 1)))
+
+    def accumulate_scans(self, data):
+        self.check_type(np.asarray(data))
+        pos = self.offset
+        while pos < len(data):
+            selected_data = data[pos + self.start:pos + self.end]
+            self.sum_values += selected_data
+            self.sum_squared_values += selected_data.astype(np.uint64)**2
+            pos += self.stride
+            self.samples += 1
+
+    def accumulate_block(self, data):
+        block = self.scans(data)
+        self.check_type(block)
+        # sums of up to 65537 and squares of 16 bit values fit into uint32
+        self.sum_values += \
+            block.sum(axis=0, dtype=np.uint32 if len(block) <= 65537
+                      else np.int64)
+        block = block.astype(np.uint32)
+        np.square(block, out=block)
+        self.sum_squared_values += block.sum(axis=0, dtype=np.uint64)
+        self.samples += len(block)
+
 
 class AveragerFactory:
 
+    engines = { 'sums': Averager, 'welford': WelfordAverager,
+                'integer': IntegerAverager }
+
     @classmethod
-    def make(cls, condition, stride, offset=0):
-        return Averager(condition.pixel_from, condition.pixel_to, stride, offset,
-                        condition.min_samples, condition.limit_diff_rms,
-                        condition.limit_diff_mean, condition.max_attempts)
+    def make(cls, condition, stride, offset=0, engine='sums',
+             convergence=Averager.BLOCKS):
+        averager = \
+            cls.engines[engine](condition.pixel_from, condition.pixel_to,
+                                stride, offset, condition.min_samples,
+                                condition.limit_diff_rms,
+                                condition.limit_diff_mean,
+                                condition.max_attempts)
+        averager.convergence = convergence
+        return averager
         
@@ -8,6 +8,84 @@ from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, \
 from pymodaq.utils.data import DataFromPlugins
 from pymodaq_plugins_transient_absorption.hardware.controller \
     import MockTAController
+from pymodaq_plugins_transient_absorption.hardware.ring_buffer \
+    import BlockRing
+from pymodaq_plugins_transient_absorption.averager import IntegerAverager
+
+
+class BlockAccumulator:
+    """Running statistics of the scans of several blocks, no raw block is
+    kept. Scans are summed up relative to the first scan taken, so that
+    sums of squares stay small enough for float32 accumulation. With an
+    integer dtype the raw counts are summed up exactly as integers. If
+    robust is set, median and MAD (scaled to rms for normal distributed
+    data) are determined per block and averaged over the blocks.
+    """
+
+    def __init__(self, dtype=np.float64, robust=False):
+        self.dtype = np.dtype(dtype)
+        self.robust = robust
+        self.clear()
+
+    def clear(self):
+        self.shift = None
+        self.sum_data = 0
+        self.squares_data = 0
+        self.center_sum = 0
+        self.spread_sum = 0
+        self.scans = 0
+        self.blocks = 0
+
+    def add(self, scans):
+        """scans of shape (scans, ...)"""
+        if len(scans) < 2:
+            raise RuntimeError("BlockAccumulator: need at least two scans")
+        self.scans += len(scans)
+        self.blocks += 1
+        if self.robust:
+            median = np.median(scans, axis=0)
+            self.center_sum += median
+            self.spread_sum += \
+                1.4826 * np.median(abs(scans - median), axis=0)
+            return
+
+        if self.dtype.kind == 'i':
+            IntegerAverager.check_type(scans)
+            self.sum_data += scans.sum(axis=0, dtype=np.int64)
+            squares = scans.astype(np.uint32)
+            np.square(squares, out=squares)
+            self.squares_data += squares.sum(axis=0, dtype=np.uint64)
+            return
+
+        if self.shift is None:
+            self.shift = scans[0].astype(self.dtype)
+        deviation = scans.astype(self.dtype)
+        deviation -= self.shift
+        self.sum_data += deviation.sum(axis=0)
+        self.squares_data += \
+            np.einsum('i...,i...->...', deviation, deviation)
+
+    def statistics(self):
+        """mean and rms, or median and MAD, as float64"""
+        if self.robust:
+            return self.center_sum / self.blocks, \
+                self.spread_sum / self.blocks
+        n_scans = self.scans
+        if self.dtype.kind == 'i':
+            return IntegerAverager.average(self.sum_data, self.squares_data,
+                                           n_scans)
+        mean = self.shift + self.sum_data / n_scans
+        rms = np.sqrt(np.maximum(self.squares_data
+                                 - self.sum_data**2 / n_scans, 0)
+                      / (n_scans - 1))
+        return mean.astype(np.float64), rms.astype(np.float64)
+
+
+def scan_statistics(scans, dtype=np.float64, robust=False):
+    """Statistics over the first axis of the scans of a single block"""
+    accumulator = BlockAccumulator(dtype, robust)
+    accumulator.add(scans)
+    return accumulator.statistics()
 
 
 class DAQ_1DViewer_MockTACamera(DAQ_Viewer_base):
@@ -28,19 +106,56 @@ class DAQ_1DViewer_MockTACamera(DAQ_Viewer_base):
           'limits': ["Free running", "S1", "S2", "S1&S2"], 'value': 'S1' },
         { 'title': 'Displayed scan', 'name': 'displayed_scan', 'type': 'int',
           'min': -1, 'value': -1 },
+        { 'title': 'Random seed', 'name': 'seed', 'type': 'int', 'min': -1,
+          'value': -1, 'tip': 'Seed of the mock data, -1 for random' },
+        { 'title': 'Replay file', 'name': 'replay_file', 'type': 'browsepath',
+          'value': '', 'filetype': True,
+          'tip': 'Recorded blocks (.npy or raw archive .raw) replayed '
+          'instead of mock data' },
+        { 'title': 'Replay rate', 'name': 'replay_rate', 'type': 'float',
+          'min': 0, 'value': 0, 'suffix': 'blocks/s',
+          'tip': '0 replays as fast as possible' },
+        { 'title': 'Ring buffer blocks', 'name': 'ring_size', 'type': 'int',
+          'min': 0, 'value': 0,
+          'tip': 'Blocks buffered between acquisition and processing, 0 '
+          'processes in the acquisition thread' },
+        { 'title': 'Overflow policy', 'name': 'overflow_policy',
+          'type': 'list', 'limits': BlockRing.policies,
+          'value': BlockRing.BLOCK },
+        { 'title': 'Accumulation', 'name': 'accumulation', 'type': 'list',
+          'limits': ['int64', 'float64', 'float32'], 'value': 'int64',
+          'tip': 'Type for summing up scans, int64 sums raw counts exactly' },
+        { 'title': 'Estimator', 'name': 'estimator', 'type': 'list',
+          'limits': ['mean/rms', 'median/MAD'], 'value': 'mean/rms' },
         ]
 
     live_mode_available = True
+    hardware_averaging = True # Naverage multiplies the number of blocks
 
     def ini_attributes(self):
         self.controller: MockTAContrller
         self.x_axis = None
         self.live = False
         self.acquisition_counter = 0
+        self.blocks_to_average = 1
+        self.accumulator = None
+        self.accumulator_changed = False
 
     def commit_settings(self, param: Parameter):
-        if param('name') == 'n_pixels':
+        if param.name() == 'n_pixels':
             self.n_pix = param.value()
+        elif param.name() in ['replay_file', 'replay_rate']:
+            self.set_up_replay()
+        elif param.name() in ['accumulation', 'estimator']:
+            # swapped by the grabbing thread before its next block
+            self.accumulator_changed = True
+
+    def set_up_replay(self):
+        if not self.settings['replay_file']:
+            self.controller.unload_recording()
+            return
+        self.controller.load_recording(self.settings['replay_file'],
+                                       self.settings['replay_rate'])
 
     def make_x_axis(self):
         self.n_pix = self.settings['n_pixels']
@@ -62,7 +177,12 @@ class DAQ_1DViewer_MockTACamera(DAQ_Viewer_base):
         initialized: bool
             False if initialization failed otherwise True
         """
-        self.controller = MockTAController() if self.is_master else controller
+        if self.is_master:
+            seed = self.settings['seed']
+            self.controller = MockTAController(None if seed < 0 else seed)
+            self.set_up_replay()
+        else:
+            self.controller = controller
 
         self.make_x_axis()
         data = [DataFromPlugins(name='camera %d' % i,
@@ -95,56 +215,91 @@ class DAQ_1DViewer_MockTACamera(DAQ_Viewer_base):
             callback = self.single_callback
             self.display_scan = self.settings['displayed_scan']
 
+        if 'live' in kwargs and not kwargs['live']:
+            self.live = False
+            self.stop_grabbing()
+            return
+
+        # n_blocks * Naverage blocks are accumulated into a single result
+        self.blocks_to_average = self.settings['n_blocks'] * Naverage
+        self.make_accumulator()
+
         if 'live' in kwargs:
-            if kwargs['live']:
-                self.live = True
-                self.controller.start_continuous_grabbing(callback)
-            else:
-                self.live = False
-                self.controller.stop_continuous_grabbing()
+            self.live = True
+            self.controller\
+                .start_continuous_grabbing(callback,
+                                           self.settings['ring_size'],
+                                           self.settings['overflow_policy'])
             return
 
-        self.controller.grab(callback)
+        n_blocks = self.blocks_to_average if callback == self.average_callback \
+            else 1
+        for _ in range(n_blocks):
+            buffer = self.controller.acquire_buffer()
+            try:
+                callback(self.controller.grab_spectrum(out=buffer))
+            finally:
+                self.controller.release_buffer(buffer)
 
     def single_callback(self, raw_data):
         data_from = 2 * self.display_scan * self.n_pix
         data = [DataFromPlugins(name='camera %d' % i,
-                                data=raw_data[data_from + i * self.n_pix
-                                              :data_from + (i + 1) * self.n_pix],
+                                data=[np.array(raw_data[data_from
+                                                        + i * self.n_pix
+                                                        :data_from + (i + 1)
+                                                        * self.n_pix])],
                                 dim='Data1D', labels=['camera %d' % i],
                                 axes=[self.x_axis])
                 for i in range(2)]
         self.dte_signal.emit(DataToExport(name='eslscpcie', data=data))
 
-    def average_callback(self, raw_data):
-        sum_data = [np.zeros(self.n_pix) for _ in range(2)]
-        squares_data = [np.zeros(self.n_pix) for _ in range(2)]
-        valid_scans = \
-            self.settings['acq_per_block'] - self.settings['clear_reads']
-        src_pos = self.settings['clear_reads'] * self.n_pix * 2
-        for _ in range(valid_scans):
-            for i in range(2):
-                raw = \
-                    raw_data[src_pos:src_pos + self.n_pix].astype(np.float64)
-                sum_data[i] += raw
-                squares_data[i] += raw**2
-                src_pos += self.n_pix
+    def scans(self, raw_data):
+        """(valid scans, 2, n_pix) view of a block, clear reads skipped"""
+        acq_per_block = self.settings['acq_per_block']
+        return raw_data[:acq_per_block * 2 * self.n_pix]\
+            .reshape(acq_per_block, 2, self.n_pix)[self.settings['clear_reads']:]
 
-        data = [DataFromPlugins(name='camera %d' % i,
-                                data=sum_data[i] / valid_scans, dim='Data1D',
-                                labels=['camera %d' % i], axes=[self.x_axis])
+    def make_accumulator(self):
+        self.accumulator_changed = False
+        self.accumulator = \
+            BlockAccumulator(self.settings['accumulation'],
+                             self.settings['estimator'] == 'median/MAD')
+
+    def average_callback(self, raw_data):
+        """Accumulates blocks and emits their statistics once
+        blocks_to_average blocks have been taken.
+        """
+        if self.accumulator is None or self.accumulator_changed:
+            self.make_accumulator()
+        self.accumulator.add(self.scans(raw_data))
+        if self.accumulator.blocks < self.blocks_to_average:
+            return
+        center, spread = self.accumulator.statistics()
+        self.accumulator.clear()
+        data = [DataFromPlugins(name='camera %d' % i, data=[center[i]],
+                                dim='Data1D', labels=['camera %d' % i],
+                                axes=[self.x_axis])
                 for i in range(2)]
-        rms = [DataFromPlugins(name='rms %d' % i,
-                               data=np.sqrt((valid_scans * squares_data[i]
-                                             - sum_data[i]**2)
-                                            / (valid_scans * (valid_scans - 1))),
+        rms = [DataFromPlugins(name='rms %d' % i, data=[spread[i]],
                                dim='Data1D', labels=['rms %d' % i],
                                axes=[self.x_axis])
-                for i in range(2)]
+               for i in range(2)]
         self.dte_signal.emit(DataToExport(name='mock lsc', data=data + rms))
 
-    def stop(self):
+    def stop_grabbing(self):
         self.controller.stop_continuous_grabbing()
+        statistics = self.controller.ring_statistics()
+        if statistics is not None:
+            self.emit_status(ThreadCommand(
+                'Update_Status',
+                ['blocks: %d, dropped: %d, max. depth: %d, '
+                 'latency: %.1f ms (max. %.1f ms)'
+                 % (statistics.produced, statistics.dropped,
+                    statistics.max_depth, statistics.mean_latency * 1000,
+                    statistics.max_latency * 1000)]))
+
+    def stop(self):
+        self.stop_grabbing()
         return ''
 
 
@@ -1,3 +1,4 @@
+import time
 from enum import Enum
 from pymodaq_utils.utils import ThreadCommand
 from pymodaq_data.data import DataToExport, Axis
@@ -9,8 +10,12 @@ from pymodaq_plugins_transient_absorption.hardware.controller \
     import MockTAController
 from pymodaq_plugins_transient_absorption.daq_viewer_plugins.plugins_1D \
     .daq_1Dviewer_MockTACamera import DAQ_1DViewer_MockTACamera
+from pymodaq_plugins_transient_absorption.averager import Averager
 from pymodaq_plugins_transient_absorption.ta_processor import TAProcessor, \
     StatisticsCondition, TACondition
+from pymodaq_plugins_transient_absorption.ta_worker import TAProcessorWorker
+from pymodaq_plugins_transient_absorption.instrumentation import \
+    instrumentation, timed
 
 
 class DAQ_1DViewer_MockTACameraMixer(DAQ_1DViewer_MockTACamera):
@@ -25,14 +30,32 @@ class DAQ_1DViewer_MockTACameraMixer(DAQ_1DViewer_MockTACamera):
 
     mode_names = ['Idle', 'Dark', 'Whitelight', 'TA']
 
+    processing_names = ['Acquisition thread', 'Worker process']
+
     params = DAQ_1DViewer_MockTACamera.params + [
-        { 'title': 'Statistic pixels', 'name': 'statistics', 'type': 'str' },
+        { 'title': 'Statistic pixels', 'name': 'statistics', 'type': 'str',
+          'value': '' },
+        { 'title': 'Statistics threads', 'name': 'statistics_threads',
+          'type': 'int', 'min': 0, 'value': 0,
+          'tip': 'Update the statistic pixel ranges concurrently with more '
+          'than one thread' },
+        { 'title': 'Convergence', 'name': 'convergence', 'type': 'list',
+          'limits': [Averager.BLOCKS, Averager.SLIDING],
+          'value': Averager.BLOCKS,
+          'tip': 'blocks: compare consecutive blocks of min. samples, '
+          'sliding: keep all samples and compare with the previous check' },
+        { 'title': 'With scatter', 'name': 'with_scatter', 'type': 'bool',
+          'value': False },
+        { 'title': 'Min. samples dark', 'name': 'min_dark',
+          'type': 'int', 'min': 0, 'value': 1000 },
         { 'title': 'Max. difference rms dark', 'name': 'limit_diff_rms_dark',
           'type': 'float', 'min': 0, 'value': 3 },
         { 'title': 'Max. difference mean dark', 'name': 'limit_diff_mean_dark',
           'type': 'float', 'min': 0, 'value': 3 },
         { 'title': 'Max. attempts dark', 'name': 'max_dark',
           'type': 'int', 'min': 1, 'value': 100 },
+        { 'title': 'Min. samples whitelight', 'name': 'min_white',
+          'type': 'int', 'min': 0, 'value': 1000 },
         { 'title': 'Max. difference rms whitelight',
           'name': 'limit_diff_rms_white', 'type': 'float', 'min': 0,
           'value': 3 },
@@ -41,49 +64,124 @@ class DAQ_1DViewer_MockTACameraMixer(DAQ_1DViewer_MockTACamera):
           'value': 3 },
         { 'title': 'Max. attempts whitelight', 'name': 'max_white',
           'type': 'int', 'min': 1, 'value': 10 },
+        { 'title': 'Max. difference whitelight TA', 'name': 'limit_diff_ta',
+          'type': 'float', 'min': 0, 'value': 3 },
+        { 'title': 'Max. blocks TA', 'name': 'max_ta', 'type': 'int',
+          'min': 0, 'value': 0, 'tip': 'End a TA point after this many '
+          'blocks, 0: no limit' },
+        { 'title': 'Max. error TA', 'name': 'max_ta_rms', 'type': 'float',
+          'min': 0, 'value': 0, 'tip': 'End a TA point once rms / '
+          'sqrt(samples) in the TA pixels is below, 0: never' },
+        { 'title': 'TA pixels', 'name': 'ta_pixels', 'type': 'str',
+          'value': '', 'tip': 'Pixel ranges for the TA error, e.g. '
+          '100-200,300-400, default: all' },
         { 'title': 'Data processing mode', 'name': 'processing_mode',
           'type': 'list', 'limits': mode_names, 'value': 'Dark' },
+        { 'title': 'Processing in', 'name': 'processing',
+          'type': 'list', 'limits': processing_names,
+          'value': processing_names[0],
+          'tip': 'A worker process keeps processing off the acquisition '
+          'and GUI threads' },
         ]
 
     def ini_attributes(self):
         super().ini_attributes()
-        self.ta_processor = TAProcessor()
+        self.ta_processor = None
+        self.instrumentation_time = 0
+
+    def ini_detector(self, controller=None):
+        info, initialized = super().ini_detector(controller)
+        self.make_processor()
+        return info, initialized
+
+    def close(self):
+        if self.ta_processor is not None:
+            self.ta_processor.close()
+        super().close()
 
     def commit_settings(self, param: Parameter):
-        if param('name') == 'processing_mode':
-            try:
-                self.ta_processor.data_processing_mode = \
-                    self.mode_names.index(param.value())
-            except:
-                pass
+        if param.name() == 'processing_mode':
+            self.ta_processor.data_processing_mode = \
+                self.mode_names.index(param.value())
+        elif param.name() == 'processing':
+            self.make_processor()
+        elif param.name() in ['statistics', 'statistics_threads',
+                              'convergence', 'with_scatter', 'min_dark',
+                              'limit_diff_rms_dark', 'limit_diff_mean_dark',
+                              'max_dark', 'min_white', 'limit_diff_rms_white',
+                              'limit_diff_mean_white', 'max_white',
+                              'limit_diff_ta', 'max_ta', 'max_ta_rms',
+                              'ta_pixels', 'n_pixels']:
+            super().commit_settings(param)
+            self.init_data()
         else:
             super().commit_settings(param)
 
+    def make_processor(self):
+        if self.ta_processor is not None:
+            self.ta_processor.close()
+        if self.settings['processing'] == 'Worker process':
+            self.ta_processor = TAProcessorWorker()
+            self.ta_processor.data_ready.connect(self.emit_processed)
+        else:
+            self.ta_processor = TAProcessor()
+        self.init_data()
+
     def init_data(self):
         ta_condition = \
-            TACondition(self.settings['limit_diff_mean_dark'],
+            TACondition(self.settings['limit_diff_rms_dark'],
                         self.settings['limit_diff_mean_dark'],
+                        self.settings['min_dark'],
                         self.settings['max_dark'],
                         self.settings['limit_diff_rms_white'],
                         self.settings['limit_diff_mean_white'],
-                        self.settings['max_white'])
-        statistics_pixel = []
-        statistics_pixels = \
-            [[int(pix) for pix in item.split('-')]
-             for item in self.settings['statistics'].split(',')]
+                        self.settings['min_white'],
+                        self.settings['max_white'],
+                        self.settings['limit_diff_ta'],
+                        self.settings['max_ta'],
+                        self.settings['max_ta_rms'])
+        statistics_pixels = self.pixel_ranges(self.settings['statistics'])
+
+        self.controller.with_scatter = self.settings['with_scatter']
+        self.ta_processor.set_up(self.n_pix, ta_condition, statistics_pixels,
+                                 self.settings['with_scatter'],
+                                 statistics_threads=
+                                 self.settings['statistics_threads'],
+                                 convergence=self.settings['convergence'],
+                                 dark_engine='integer',
+                                 ta_ranges=
+                                 self.pixel_ranges(self.settings['ta_pixels']))
 
-        self.ta_processor.set_up(self.n_pixels, ta_condition, statistics_pixels)
+    @staticmethod
+    def pixel_ranges(text):
+        return [[int(pix) for pix in item.split('-')]
+                for item in text.split(',') if item.strip()]
 
+    @timed('callback')
     def single_callback(self, raw_data):
-        dte, display = self.ta_processor.process_data(raw_data)
+        if isinstance(self.ta_processor, TAProcessorWorker):
+            # results arrive through data_ready
+            self.ta_processor.process_data(raw_data)
+            return
+        self.emit_processed(*self.ta_processor.process_data(raw_data))
+
+    average_callback = single_callback
 
+    @timed('export')
+    def emit_processed(self, dte, store):
         if dte is None:
             return
 
-        if display:
-            self.dte_signal_temp.emit(dte)
-        else:
+        if store:
             self.dte_signal.emit(dte)
+        else:
+            self.dte_signal_temp.emit(dte)
+
+        if instrumentation.enabled \
+           and time.monotonic() - self.instrumentation_time > 1:
+            # stages timed in a worker process are not included
+            self.instrumentation_time = time.monotonic()
+            self.dte_signal_temp.emit(instrumentation.to_dte())
 
 
 if __name__ == '__main__':
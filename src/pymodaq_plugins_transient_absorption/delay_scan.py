@@ -0,0 +1,305 @@
+""" Automated delay scan: the delay line steps through a linear,
+logarithmic or lin-log schedule and at every delay a TA spectrum is
+accumulated by a TAProcessor until it converges or a maximum number of
+blocks is reached. Dark and whitelight references are measured once before
+the scan, per point only the TA accumulation is reset.
+
+Grabbing and processing run in separate threads: as soon as the last block
+of a point is grabbed the stage moves on while the blocks still queued are
+processed and the point is handed to the callback.
+
+In adaptive mode every point ends once its TA error is below max_ta_rms of
+the processor (see TAProcessor.check_ta_budget). The scan has a budget of
+max_ta blocks per delay in total, the blocks saved by quickly converging
+points go to the following points and finally to the noisiest points that
+didn't converge, which are measured again and merged.
+"""
+import time
+import queue
+import numpy as np
+from dataclasses import dataclass, replace
+from threading import Thread, Event
+from pymodaq.utils.data import DataActuator
+from pymodaq_plugins_transient_absorption.averager import Averager, \
+    WelfordAverager
+from pymodaq_plugins_transient_absorption.ta_processor import TAProcessor
+from pymodaq_plugins_transient_absorption.hardware.ring_buffer import \
+    BlockPool
+
+
+@dataclass
+class DelaySchedule:
+    """Delays of a scan. Linear: start to end in steps of step. Log: n_log
+    delays, equally spaced on a log scale from start to end (start > 0).
+    Lin-log: linear from start to linear_end, followed by n_log delays on a
+    log scale up to end.
+    """
+
+    LINEAR  = 'linear'
+    LOG     = 'log'
+    LIN_LOG = 'lin-log'
+    modes = [LINEAR, LOG, LIN_LOG]
+
+    mode: str = LINEAR
+    start: float = 0
+    end: float = 1
+    step: float = 0.1
+    linear_end: float = 1
+    n_log: int = 10
+
+    def delays(self):
+        if self.mode == self.LINEAR:
+            return self.linear(self.start, self.end)
+        if self.mode == self.LOG:
+            if self.start <= 0 or self.end <= 0:
+                raise ValueError("DelaySchedule: log scale needs positive "
+                                 "start and end")
+            return np.geomspace(self.start, self.end, self.n_log)
+        if self.mode == self.LIN_LOG:
+            if self.linear_end <= 0 or self.end <= self.linear_end:
+                raise ValueError("DelaySchedule: log part needs "
+                                 "0 < linear_end < end")
+            return np.concatenate(
+                (self.linear(self.start, self.linear_end),
+                 np.geomspace(self.linear_end, self.end, self.n_log + 1)[1:]))
+        raise ValueError("DelaySchedule: unknown mode %s" % self.mode)
+
+    def linear(self, start, end):
+        if self.step <= 0:
+            raise ValueError("DelaySchedule: step has to be positive")
+        # tolerance: end is part of the schedule despite rounding
+        n_steps = int(np.floor((end - start) / self.step * (1 + 1e-9)))
+        return start + self.step * np.arange(n_steps + 1)
+
+
+@dataclass
+class ScanPoint:
+    delay: float
+    result: int # Averager.SUCCESS, FAIL or CONTINUE if out of blocks
+    blocks: int
+    samples: int
+    mean: np.ndarray
+    rms: np.ndarray
+    error: float = np.nan # TA error, see TAProcessor.ta_error
+    converged: bool = False
+
+
+def actuator_move(plugin, units=None):
+    """Move function for DelayScan driving a DAQ_Move plugin, e.g.
+    DAQ_Move_MockDelayLine, delays in units (default: the axis unit).
+    """
+    units = plugin.axis_unit if units is None else units
+    return lambda delay: plugin.move_abs(DataActuator(data=delay,
+                                                      units=units))
+
+
+class DelayScan:
+    """Drives controller and processor through the delays. The processor
+    needs dark and whitelight references (set_dark,
+    set_whitelight_references or a previous acquisition). move(delay)
+    positions the stage, default is controller.set_delay_value. Without
+    adaptive a point takes at most max_blocks blocks. A TAMatrix given as
+    matrix gets every point, each run is one scan of it.
+    """
+
+    report_dtype = np.dtype([('delay', '<f8'), ('blocks', '<i8'),
+                             ('samples', '<i8'), ('error', '<f8'),
+                             ('converged', '?')])
+
+    def __init__(self, controller, processor: TAProcessor, delays, move=None,
+                 max_blocks=100, pool_size=4, adaptive=False, matrix=None):
+        if processor.whitelight_checker is None:
+            raise ValueError("DelayScan: processor has no whitelight "
+                             "references")
+        if adaptive and not processor.max_ta:
+            raise ValueError("DelayScan: adaptive scan needs max_ta")
+        self.controller = controller
+        self.processor = processor
+        self.delays = np.asarray(delays)
+        self.move = controller.set_delay_value if move is None else move
+        self.max_blocks = max_blocks
+        self.pool_size = pool_size
+        self.adaptive = adaptive
+        self.matrix = matrix
+        self.points = []
+        self.blocks = 0
+        self.budget = 0
+        self.move_time = 0
+        self.error = None
+        self._stop = Event()
+        self._queue = queue.Queue()
+
+    def stop(self):
+        """Ends the scan after the current block"""
+        self._stop.set()
+
+    def run(self, callback=None):
+        """Scans all delays and returns the ScanPoints. callback(point) is
+        called from the processing thread as soon as a point is done, again
+        with the merged point if it is refined.
+        """
+        n_delays = len(self.delays)
+        self.points = [None] * n_delays
+        self.blocks = 0
+        self.move_time = 0
+        self._stop.clear()
+        max_ta = self.processor.max_ta
+        pool = BlockPool(self.pool_size, self.controller.camera.block_size)
+        thread = Thread(target=self.process_loop, args=(pool, callback),
+                        daemon=True)
+        thread.start()
+        try:
+            if self.adaptive:
+                self.budget = max_ta * n_delays
+                for i in range(n_delays):
+                    self.acquire(i, (self.budget - self.blocks)
+                                 // (n_delays - i), pool)
+                self.refine(pool)
+            else:
+                self.budget = self.max_blocks * n_delays
+                for i in range(n_delays):
+                    self.acquire(i, self.max_blocks, pool)
+        finally:
+            self._queue.put(None)
+            thread.join()
+            self.processor.max_ta = max_ta
+            if self.matrix is not None:
+                self.matrix.end_scan()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("DelayScan: processing failed") from error
+        return [point for point in self.points if point is not None]
+
+    def run_scans(self, n_scans, callback=None):
+        """Repeats the scan n_scans times or until stopped, the scans are
+        accumulated in matrix, e.g. a ScanAccumulator.
+        """
+        if self.matrix is None:
+            raise ValueError("DelayScan: repeated scans need a matrix")
+        for _ in range(n_scans):
+            self.run(callback)
+            if self._stop.is_set():
+                break
+        return self.matrix
+
+    def acquire(self, index, budget, pool):
+        """Moves to delay index and grabs up to budget blocks, less if the
+        processor is done before.
+        """
+        if self._stop.is_set() or budget < 1:
+            return
+        start = time.perf_counter()
+        self.move(self.delays[index])
+        self.move_time += time.perf_counter() - start
+        done = Event()
+        self._queue.put(('start', index, budget if self.adaptive else None,
+                         done))
+        blocks = 0
+        while blocks < budget and not done.is_set() \
+              and not self._stop.is_set():
+            buffer = pool.acquire()
+            self.controller.grab_spectrum(out=buffer)
+            self._queue.put(('block', buffer))
+            blocks += 1
+        self.blocks += blocks
+        self._queue.put(('end', index, blocks))
+
+    def refine(self, pool):
+        """Spends the blocks left on the points which didn't converge,
+        noisiest first.
+        """
+        self._queue.join()
+        noisy = [i for i, point in enumerate(self.points)
+                 if point is not None and not point.converged]
+        noisy.sort(key=lambda i: -np.nan_to_num(self.points[i].error,
+                                                nan=np.inf))
+        for n, index in enumerate(noisy):
+            self.acquire(index, (self.budget - self.blocks)
+                         // (len(noisy) - n), pool)
+
+    def report(self):
+        """Blocks, samples, TA error and convergence of every point"""
+        points = [point for point in self.points if point is not None]
+        report = np.zeros(len(points), dtype=self.report_dtype)
+        for i, point in enumerate(points):
+            report[i] = (point.delay, point.blocks, point.samples,
+                         point.error, point.converged)
+        return report
+
+    def process_loop(self, pool, callback):
+        processor = self.processor
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            try:
+                if item[0] == 'block':
+                    try:
+                        if processor.data_processing_mode == TAProcessor.TA \
+                           and self.error is None:
+                            _, store = processor.process_data(item[1])
+                            if processor.data_processing_mode \
+                               == TAProcessor.IDLE:
+                                result = Averager.SUCCESS if store \
+                                    else Averager.FAIL
+                                done.set()
+                    finally:
+                        pool.release(item[1])
+
+                elif item[0] == 'start':
+                    _, index, budget, done = item
+                    processor.clear_accumulation()
+                    if budget is not None:
+                        processor.max_ta = budget
+                    processor.data_processing_mode = TAProcessor.TA
+                    result = Averager.CONTINUE
+
+                elif self.error is None: # end of point
+                    processor.data_processing_mode = TAProcessor.IDLE
+                    point = self.make_point(self.delays[index], result,
+                                            item[2])
+                    if self.points[index] is not None:
+                        point = self.merge(self.points[index], point)
+                    self.points[index] = point
+                    if self.matrix is not None:
+                        self.matrix.update(index, point.mean, point.rms,
+                                           point.samples)
+                    if callback is not None:
+                        callback(point)
+
+            except Exception as e:
+                self.error = e
+                self._stop.set()
+            finally:
+                self._queue.task_done()
+
+    def make_point(self, delay, result, blocks):
+        processor = self.processor
+        averager = processor.ta_averager
+        if averager.samples < 2:
+            mean = rms = np.full(processor.n_pix, np.nan)
+            error = np.nan
+        else:
+            mean, rms = averager.mean.copy(), averager.rms.copy()
+            error = processor.ta_error(rms, averager.samples)
+        return ScanPoint(float(delay), result, blocks, averager.samples,
+                         mean, rms, error, processor.ta_converged)
+
+    def merge(self, point, other):
+        """Point with the pooled statistics of two points of one delay"""
+        blocks = point.blocks + other.blocks
+        if other.samples < 2:
+            return replace(point, blocks=blocks)
+        if point.samples < 2:
+            return replace(other, blocks=blocks)
+        samples, mean, m2 = \
+            WelfordAverager.merge(point.samples, point.mean,
+                                  point.rms**2 * (point.samples - 1),
+                                  other.samples, other.mean,
+                                  other.rms**2 * (other.samples - 1))
+        rms = np.sqrt(m2 / (samples - 1))
+        error = self.processor.ta_error(rms, samples)
+        converged = 0 < error <= self.processor.max_ta_rms
+        return ScanPoint(point.delay, min(point.result, other.result), blocks,
+                         samples, mean, rms, error, converged)
@@ -0,0 +1,57 @@
+import time
+from qtpy.QtCore import QObject, QTimer, Signal
+from pymodaq_plugins_transient_absorption.instrumentation import \
+    instrumentation
+
+
+class DisplayCoalescer(QObject):
+    """Decouples plotting from data arrival: show() only keeps the latest
+    data for every viewer, a timer hands it to viewer.show_data at most
+    frame_rate times per second. Data replaced before being shown count as
+    dropped frames. rendered is emitted after every repaint with the time
+    it took (s) and the total of dropped frames.
+    """
+
+    rendered = Signal(float, int)
+
+    frame_rate = 20
+
+    def __init__(self, frame_rate=None, parent=None):
+        QObject.__init__(self, parent)
+        self.pending = {}
+        self.render_time = 0
+        self.frames = 0
+        self.dropped = 0
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.render)
+        self.set_frame_rate(frame_rate or self.frame_rate)
+
+    def set_frame_rate(self, frame_rate):
+        self.frame_rate = frame_rate
+        self.timer.start(int(1000 / frame_rate))
+
+    def show(self, viewer, data):
+        if data is None:
+            return
+        if viewer in self.pending:
+            self.dropped += 1
+        self.pending[viewer] = data
+
+    def render(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        start = time.perf_counter()
+        for viewer, data in pending.items():
+            viewer.show_data(data)
+        self.render_time = time.perf_counter() - start
+        instrumentation.count('render', int(self.render_time * 1e9))
+        self.frames += 1
+        self.rendered.emit(self.render_time, self.dropped)
+
+    def clear(self):
+        """Forgets pending data, e.g. when the acquisition stops"""
+        self.pending = {}
+
+    def stop(self):
+        self.timer.stop()
@@ -1,6 +1,12 @@
+import time
 import numpy as np
-from dataclasses import dataclass
-from threading import Thread
+from dataclasses import dataclass, replace
+from threading import Thread, Lock
+from pymodaq_plugins_transient_absorption.hardware.ring_buffer import \
+    BlockRing, BlockPool
+from pymodaq_plugins_transient_absorption.hardware.raw_archive import \
+    RawArchive, RawArchiveWriter, is_archive
+from pymodaq_plugins_transient_absorption.instrumentation import timed
 
 class MockActuator:
 
@@ -58,10 +64,17 @@ class MockTACamera:
     parallel_waveplate: float = 15 / 180 * np.pi
     laser_polarization: float = 2 / 180 * np.pi
     scans_per_block: int = 250
+    seed: int = None
+    gaussian_shot_noise_limit: float = 1000
 
     def __post_init__(self):
+        self.rng = np.random.default_rng(self.seed)
         self.calculate_base_data()
 
+    @property
+    def block_size(self):
+        return 2 * self.n_pixels * self.scans_per_block
+
     def calculate_base_data(self):
         n_pix = self.n_pixels
         pixels = np.linspace(0, n_pix - 1, n_pix)
@@ -70,54 +83,58 @@ class MockTACamera:
         self.esa = np.exp(-((pixels - 3 * n_pix / 4) / (n_pix / 8))**2)
         self.scatter = np.exp(-((pixels - n_pix / 4) / (n_pix / 16))**2)
 
+    def calculate_absorption(self, delay: float, polarizer_angle: float):
+        time_factor = np.exp(-delay / self.life_time)
+        anisotropy_factor = np.exp(delay / self.decorrelation_time)
+
+        gsb_amplitude = -self.bleach * time_factor
+        bleach = gsb_amplitude * (1 + 0.8 * anisotropy_factor) \
+            * np.cos(polarizer_angle)**2 \
+            + gsb_amplitude * (1 - 0.4 * anisotropy_factor) \
+            * np.sin(polarizer_angle)**2
+
+        esa_amplitude = self.excited_state_absorption * time_factor
+        esa = esa_amplitude * (1 + 0.8 * anisotropy_factor) \
+            * np.cos(polarizer_angle - self.excited_state_angle)**2 \
+            + esa_amplitude * (1 - 0.4 * anisotropy_factor) \
+            * np.sin(polarizer_angle - self.excited_state_angle)**2
+
+        return bleach * self.gsb + esa * self.esa
+
     def calculate_scan(self, delay: float, polarizer_angle: float,
                        excitation: bool, probe: bool):
 
         # dark
         signal_photo_electrons = \
-            np.random.normal(loc=self.dark_signal, scale=self.rms_dark_signal,
-                             size=self.n_pixels) \
+            self.rng.normal(loc=self.dark_signal, scale=self.rms_dark_signal,
+                            size=self.n_pixels) \
             * self.photo_electrons_per_lsb
         reference_photo_electrons = \
-            np.random.normal(loc=self.dark_reference, scale=self.rms_dark_signal,
-                             size=self.n_pixels) \
+            self.rng.normal(loc=self.dark_reference,
+                            scale=self.rms_dark_signal, size=self.n_pixels) \
             * self.photo_electrons_per_lsb
 
         if excitation:
             # scatter
             signal_photo_electrons += \
                 self.excitation_scatter * \
-                np.random.normal(loc=1, scale=self.relative_rms_scatter) \
+                self.rng.normal(loc=1, scale=self.relative_rms_scatter) \
                 * self.scatter * self.photo_electrons_per_lsb
 
         if probe:
-            fluct_I0 = np.random.normal(loc=1, scale=self.relative_rms_signal)
+            fluct_I0 = self.rng.normal(loc=1, scale=self.relative_rms_signal)
             signal = self.whitelight * self.signal * fluct_I0
             reference = self.whitelight * self.reference * fluct_I0
 
             if excitation:
-                time_factor = np.exp(-delay / self.life_time)
-                anisotropy_factor = np.exp(delay / self.decorrelation_time)
-
-                gsb_amplitude = -self.bleach * time_factor
-                bleach = gsb_amplitude * (1 + 0.8 * anisotropy_factor) \
-                    * np.cos(polarizer_angle)**2 \
-                    + gsb_amplitude * (1 - 0.4 * anisotropy_factor) \
-                    * np.sin(polarizer_angle)**2
-
-                esa_amplitude = self.excited_state_absorption * time_factor
-                esa = esa_amplitude * (1 + 0.8 * anisotropy_factor) \
-                    * np.cos(polarizer_angle - self.excited_state_angle)**2 \
-                    + esa_amplitude * (1 - 0.4 * anisotropy_factor) \
-                    * np.sin(polarizer_angle - self.excited_state_angle)**2
-
-                absorption = bleach * self.gsb + esa * self.esa
+                absorption = \
+                    self.calculate_absorption(delay, polarizer_angle)
                 signal *= np.power(10, -absorption)
 
             signal_photo_electrons += \
-                np.random.poisson(signal * self.photo_electrons_per_lsb)
+                self.rng.poisson(signal * self.photo_electrons_per_lsb)
             reference_photo_electrons += \
-                np.random.poisson(reference * self.photo_electrons_per_lsb)
+                self.rng.poisson(reference * self.photo_electrons_per_lsb)
 
         signal = signal_photo_electrons / self.photo_electrons_per_lsb
         reference = reference_photo_electrons / self.photo_electrons_per_lsb
@@ -130,32 +147,70 @@ class MockTACamera:
             return signal.astype(np.uint16), reference.astype(np.uint16)
         return signal.astype(np.uint32), reference.astype(np.uint32)
 
+    def shot_noise(self, photo_electrons):
+        """Poisson distributed counts, approximated by a normal distribution
+        above gaussian_shot_noise_limit photo electrons which is much faster
+        and for such counts indistinguishable.
+        """
+        result = photo_electrons + np.sqrt(photo_electrons) \
+            * self.rng.standard_normal(photo_electrons.shape)
+        low = photo_electrons < self.gaussian_shot_noise_limit
+        if np.any(low):
+            result[low] = self.rng.poisson(photo_electrons[low])
+        return result
+
     def calculate_block(self, delay: float, polarizer_angle: float,
-                        excitation: bool, probe: bool, scatter: bool):
+                        excitation: bool, probe: bool, scatter: bool,
+                        out=None):
+        """All scans of a block at once. Scans cycle through pumped,
+        unpumped and, with scatter, pump only and dark. The result is
+        written into out if given.
+        """
         n_pix = self.n_pixels
-        data_size = self.n_pixels * 2 * self.scans_per_block
-
-        data = np.empty(data_size, dtype=np.uint16)
-        dest = 0
-        while dest < data_size:
-            data[dest:dest+n_pix], data[dest+n_pix:dest+2*n_pix] = \
-                 self.calculate_scan(delay, polarizer_angle, excitation, probe)
-            dest += 2 * n_pix
-            data[dest:dest+n_pix], data[dest+n_pix:dest+2*n_pix] = \
-                self.calculate_scan(delay, polarizer_angle, False, probe)
-            dest += 2 * n_pix
-            if not scatter:
-                continue
-            if dest >= data_size:
-                break
-            data[dest:dest+n_pix], data[dest+n_pix:dest+2*n_pix] = \
-                self.calculate_scan(delay, polarizer_angle, excitation, False)
-            dest += 2 * n_pix
-            data[dest:dest+n_pix], data[dest+n_pix:dest+2*n_pix] = \
-                self.calculate_scan(delay, polarizer_angle, False, False)
-            dest += 2 * n_pix
+        n_scans = self.scans_per_block
+        per_lsb = self.photo_electrons_per_lsb
+        pattern = np.arange(n_scans) % (4 if scatter else 2)
+        pumped = np.logical_and(pattern % 2 == 0, excitation)
+        probed = np.logical_and(pattern < 2, probe)
 
-        return data
+        # dark
+        dark = np.array([[self.dark_signal], [self.dark_reference]])
+        photo_electrons = \
+            self.rng.normal(loc=dark, scale=self.rms_dark_signal,
+                            size=(n_scans, 2, n_pix))
+        photo_electrons *= per_lsb
+
+        n_pumped = np.count_nonzero(pumped)
+        if n_pumped:
+            # scatter
+            amplitude = self.excitation_scatter * per_lsb \
+                * self.rng.normal(loc=1, scale=self.relative_rms_scatter,
+                                  size=n_pumped)
+            photo_electrons[pumped, 0] += amplitude[:, np.newaxis] \
+                * self.scatter
+
+        n_probed = np.count_nonzero(probed)
+        if n_probed:
+            fluct_I0 = self.rng.normal(loc=1, scale=self.relative_rms_signal,
+                                       size=(n_probed, 1))
+            light = np.empty((n_probed, 2, n_pix))
+            light[:, 0] = self.whitelight * (self.signal * per_lsb) * fluct_I0
+            light[:, 1] = \
+                self.whitelight * (self.reference * per_lsb) * fluct_I0
+            excited = pumped[probed]
+            if np.any(excited):
+                absorption = \
+                    self.calculate_absorption(delay, polarizer_angle)
+                light[excited, 0] *= np.power(10, -absorption)
+            photo_electrons[probed] += self.shot_noise(light)
+
+        photo_electrons /= per_lsb
+        np.clip(photo_electrons, 0, 2**self.adc_bits - 1, out=photo_electrons)
+        if out is None:
+            out = np.empty(n_scans * 2 * n_pix, dtype=np.uint16)
+        np.copyto(out.reshape(n_scans, 2, n_pix), photo_electrons,
+                  casting='unsafe')
+        return out
 
 
 class MockTAController:
@@ -163,14 +218,24 @@ class MockTAController:
     polarizer_names = ['Polarizer', 'Lambda/2']
     shutter_names = ['Excitation', 'Probe']
 
-    def __init__(self):
-        self.camera = MockTACamera()
+    def __init__(self, seed=None):
+        self.camera = MockTACamera(seed=seed)
         self.delay_line = MockDelayLine()
         self.shutters = { name: MockShutter() for name in self.shutter_names }
         self.polarizers = \
             { name: MockPolarizer() for name in self.polarizer_names }
         self.with_scatter = False
         self._thread = None
+        self._consumer_thread = None
+        self.ring = None
+        self._scratch = None
+        self.pool = None
+        self.pool_size = 4
+        self.recording = None
+        self.replay_rate = 0
+        self._replay_position = 0
+        self.archive = None
+        self._archive_lock = Lock()
 
     def get_polarizer_value(self, axis):
         return self.polarizers[axis].get_value()
@@ -181,7 +246,7 @@ class MockTAController:
     def get_delay_value(self):
         return self.delay_line.get_value()
 
-    def set_delay_value(selfvalue):
+    def set_delay_value(self, value):
         self.delay_line.move_at(value)
 
     def get_shutter_value(self, shutter):
@@ -190,31 +255,184 @@ class MockTAController:
     def set_shutter_value(self, value, shutter):
         self.shutters[shutter].move_at(value)
 
-    def grab_spectrum(self):
+    @timed('grab')
+    def grab_spectrum(self, out=None):
+        if self.recording is not None:
+            block = self.replay_block()
+            if out is None:
+                return block
+            np.copyto(out, block)
+            return out
+        block = self.generate_block(out)
+        with self._archive_lock:
+            if self.archive is not None:
+                self.archive_block(self.archive, block)
+        return block
+
+    def generate_block(self, out=None):
+        """Mock camera block for the current settings"""
         return self.camera\
             .calculate_block(self.delay_line.get_value(),
                              self.polarizers['Polarizer'].get_value(),
                              self.shutters['Excitation'].get_value() > 0,
                              self.shutters['Probe'].get_value() > 0,
-                             self.with_scatter)
-
-    def start_continuous_grabbing(self, callback):
+                             self.with_scatter, out=out)
+
+    def start_archiving(self, path):
+        """Appends every generated block with its settings to the raw
+        archive at path (see raw_archive).
+        """
+        with self._archive_lock:
+            if self.archive is not None:
+                self.archive.close()
+            self.archive = RawArchiveWriter(path)
+
+    def stop_archiving(self):
+        with self._archive_lock:
+            if self.archive is not None:
+                self.archive.close()
+                self.archive = None
+
+    def archive_block(self, archive, block):
+        archive.append(block, self.camera.n_pixels,
+                       self.delay_line.get_value(),
+                       self.polarizers['Polarizer'].get_value(),
+                       self.shutters['Excitation'].get_value() > 0,
+                       self.shutters['Probe'].get_value() > 0,
+                       self.with_scatter)
+
+    def record_blocks(self, path, n_blocks):
+        """Dumps n_blocks generated with the current settings into a
+        memory-mapped .npy file of shape (n_blocks, block size), or appends
+        them to a raw archive if path ends with .raw.
+        """
+        if str(path).endswith('.raw'):
+            with RawArchiveWriter(path) as archive:
+                for _ in range(n_blocks):
+                    self.archive_block(archive, self.generate_block())
+            return
+        recording = np.lib.format.open_memmap(
+            path, mode='w+', dtype=np.uint16,
+            shape=(n_blocks, self.camera.block_size))
+        for block in recording:
+            self.generate_block(out=block)
+        recording.flush()
+        del recording
+
+    def load_recording(self, path, rate=0):
+        """Replays the blocks of a recording (.npy or raw archive) cyclically
+        instead of generating them, at rate blocks per second or as fast as
+        possible if rate is 0.
+        """
+        self.recording = RawArchive(path) if is_archive(path) \
+            else np.load(path, mmap_mode='r')
+        self.replay_rate = rate
+        self._replay_position = 0
+
+    def unload_recording(self):
+        self.recording = None
+
+    def replay_block(self):
+        """Next recorded block, a read-only view into the memory map"""
+        block = self.recording[self._replay_position]
+        self._replay_position = \
+            (self._replay_position + 1) % len(self.recording)
+        return block
+
+    def start_continuous_grabbing(self, callback, ring_size=0,
+                                  policy=BlockRing.BLOCK):
+        """Grabs blocks in a thread and passes them to callback. With a
+        ring_size > 0 the callback runs in a separate consumer thread,
+        decoupled from acquisition by a ring buffer of ring_size blocks.
+        """
         if self._thread is None:
             self._callback = callback
             self._stop = False
-            self._thread = Thread(target=self.grab_loop)
+            if ring_size > 0:
+                self.ring = BlockRing(ring_size, self.camera.block_size, policy)
+                # target of blocks the ring drops
+                self._scratch = np.empty(self.camera.block_size,
+                                         dtype=self.ring.blocks.dtype)
+                self._consumer_thread = Thread(target=self.consume_loop)
+                self._consumer_thread.start()
+                self._thread = Thread(target=self.produce_loop)
+            else:
+                self.ring = None
+                self._thread = Thread(target=self.grab_loop)
             self._thread.start()
 
     def stop_continuous_grabbing(self):
         if self._thread is not None:
             self._stop = True
+            if self.ring is not None:
+                self.ring.close()
             self._thread.join()
             self._thread = None
+            if self._consumer_thread is not None:
+                self._consumer_thread.join()
+                self._consumer_thread = None
+
+    def acquire_buffer(self, timeout=None):
+        """Reusable block buffer, to be given back with release_buffer once
+        the consumer is done with it.
+        """
+        if self.pool is None or self.pool.block_size != self.camera.block_size:
+            self.pool = BlockPool(self.pool_size, self.camera.block_size)
+        return self.pool.acquire(timeout)
+
+    def release_buffer(self, buffer):
+        self.pool.release(buffer)
+
+    def ring_statistics(self):
+        """Snapshot of the ring buffer counters, None without ring buffer"""
+        if self.ring is None:
+            return None
+        return replace(self.ring.statistics)
+
+    def wait_for_replay_slot(self):
+        if self.recording is None or self.replay_rate <= 0:
+            return
+        self._next_replay_time += 1 / self.replay_rate
+        delay = self._next_replay_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else: # behind schedule, don't try to catch up
+            self._next_replay_time -= delay
 
     def grab_loop(self):
+        self._next_replay_time = time.monotonic()
+        while not self._stop:
+            self.wait_for_replay_slot()
+            if self.recording is not None: # zero copy view of the recording
+                self._callback(self.grab_spectrum())
+                continue
+            buffer = self.acquire_buffer()
+            try:
+                self._callback(self.grab_spectrum(out=buffer))
+            finally:
+                self.release_buffer(buffer)
+
+    def produce_loop(self):
+        self._next_replay_time = time.monotonic()
         while not self._stop:
-            data = self.grab_spectrum()
-            self._callback(data)
+            self.wait_for_replay_slot()
+            slot = self.ring.reserve()
+            if slot is None: # dropped, but the camera delivers anyway
+                if not self._stop:
+                    self.grab_spectrum(out=self._scratch)
+                continue
+            self.grab_spectrum(out=self.ring.blocks[slot])
+            self.ring.commit(slot)
+
+    def consume_loop(self):
+        while True:
+            slot = self.ring.take()
+            if slot is None:
+                break
+            try:
+                self._callback(self.ring.blocks[slot])
+            finally:
+                self.ring.release(slot)
 
 
 if __name__ == '__main__':
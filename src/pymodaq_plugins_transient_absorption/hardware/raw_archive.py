@@ -0,0 +1,128 @@
+import os
+import time
+import numpy as np
+
+
+# one entry per block, offset and size in bytes into the data file
+INDEX_DTYPE = np.dtype([('delay', '<f8'), ('polarizer', '<f8'),
+                        ('pump', '?'), ('probe', '?'), ('with_scatter', '?'),
+                        ('n_pixels', '<u4'), ('timestamp', '<f8'),
+                        ('offset', '<u8'), ('size', '<u8')])
+
+
+def archive_paths(path):
+    """Data and index file of the archive path, with or without extension"""
+    path = os.fspath(path)
+    base, extension = os.path.splitext(path)
+    if extension in ['.raw', '.idx']:
+        path = base
+    return path + '.raw', path + '.idx'
+
+
+def is_archive(path):
+    return os.fspath(path).endswith(('.raw', '.idx')) \
+        and all(os.path.exists(p) for p in archive_paths(path))
+
+
+class RawArchiveWriter:
+    """Appends uint16 camera blocks to the data file of an archive and an
+    index entry per block to its index file. The data are flushed before
+    the index entry is written, readers never see an entry without its
+    data.
+    """
+
+    def __init__(self, path):
+        self.data_path, self.index_path = archive_paths(path)
+        self.data_file = open(self.data_path, 'ab')
+        self.index_file = open(self.index_path, 'ab')
+        self.offset = self.data_file.tell()
+        self._entry = np.zeros(1, INDEX_DTYPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, block, n_pixels, delay=0, polarizer=0, pump=True,
+               probe=True, with_scatter=False, timestamp=None):
+        block = np.ascontiguousarray(block, dtype=np.uint16)
+        self.data_file.write(block.data)
+        self.data_file.flush()
+        entry = self._entry[0]
+        entry['delay'] = delay
+        entry['polarizer'] = polarizer
+        entry['pump'] = pump
+        entry['probe'] = probe
+        entry['with_scatter'] = with_scatter
+        entry['n_pixels'] = n_pixels
+        entry['timestamp'] = time.time() if timestamp is None else timestamp
+        entry['offset'] = self.offset
+        entry['size'] = block.nbytes
+        self.index_file.write(self._entry.tobytes())
+        self.offset += block.nbytes
+
+    def flush(self):
+        self.data_file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        if self.data_file is None:
+            return
+        self.data_file.close()
+        self.index_file.close()
+        self.data_file = None
+
+
+class RawArchive:
+    """Read access to an archive: the index as structured array and every
+    block as a read-only view into the memory mapped data file, nothing is
+    copied. Pickling only transfers the path, a worker process maps the
+    files itself.
+    """
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self.data_path, self.index_path = archive_paths(path)
+        self.index = np.fromfile(self.index_path, dtype=INDEX_DTYPE)
+        if len(self.index):
+            end = int(self.index['offset'][-1] + self.index['size'][-1])
+            self.data = np.memmap(self.data_path, dtype=np.uint16, mode='r',
+                                  shape=(end // 2,))
+        else:
+            self.data = np.zeros(0, dtype=np.uint16)
+
+    def __reduce__(self):
+        return self.__class__, (self.path,)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return self.block(i)
+
+    def block(self, i):
+        entry = self.index[i]
+        start = int(entry['offset']) // 2
+        return self.data[start:start + int(entry['size']) // 2]
+
+    def blocks(self, indices=None):
+        for i in range(len(self)) if indices is None else indices:
+            yield self.block(i)
+
+    def select(self, **conditions):
+        """Indices of the blocks whose index fields equal the given values,
+        e.g. select(delay=1e-12, pump=True)
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for field, value in conditions.items():
+            mask &= self.index[field] == value
+        return np.flatnonzero(mask)
+
+    def groups(self, field='delay'):
+        """Block indices per distinct value of field, in order of first
+        appearance, for processing the groups independently.
+        """
+        values, first = np.unique(self.index[field], return_index=True)
+        return { value.item(): np.flatnonzero(self.index[field] == value)
+                 for value in values[np.argsort(first)] }
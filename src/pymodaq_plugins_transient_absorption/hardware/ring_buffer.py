@@ -0,0 +1,143 @@
+import time
+import numpy as np
+from collections import deque
+from dataclasses import dataclass
+from threading import Condition
+
+
+@dataclass
+class RingStatistics:
+
+    produced: int = 0
+    consumed: int = 0
+    dropped: int = 0
+    depth: int = 0
+    max_depth: int = 0
+    latency: float = 0 # seconds from commit to release of last block
+    mean_latency: float = 0
+    max_latency: float = 0
+
+
+class BlockRing:
+    """Preallocated ring of blocks between a producer (the grab thread) and
+    a consumer thread. The producer reserves a free slot, fills it and
+    commits it, the consumer takes the oldest committed slot and releases it
+    when done. What happens when no slot is free is decided by the overflow
+    policy: wait for the consumer, overwrite the oldest queued block or drop
+    the new one.
+    """
+
+    BLOCK       = 'block'
+    DROP_OLDEST = 'drop oldest'
+    DROP_NEWEST = 'drop newest'
+
+    policies = [BLOCK, DROP_OLDEST, DROP_NEWEST]
+
+    def __init__(self, n_slots, block_size, policy=BLOCK, dtype=np.uint16):
+        if policy not in self.policies:
+            raise ValueError("BlockRing: unknown overflow policy %s" % policy)
+        self.blocks = np.empty((n_slots, block_size), dtype=dtype)
+        self.policy = policy
+        self.statistics = RingStatistics()
+        self._free = deque(range(n_slots))
+        self._queue = deque()
+        self._commit_times = np.zeros(n_slots)
+        self._condition = Condition()
+        self._closed = False
+
+    def reserve(self):
+        """Index of a free slot for the next block, None if the block has to
+        be dropped or the ring has been closed.
+        """
+        with self._condition:
+            while not self._free and not self._closed:
+                if self.policy == self.DROP_NEWEST:
+                    self.statistics.dropped += 1
+                    return None
+                if self.policy == self.DROP_OLDEST and self._queue:
+                    self._free.append(self._queue.popleft())
+                    self.statistics.dropped += 1
+                    self.statistics.depth = len(self._queue)
+                    break
+                self._condition.wait()
+            if self._closed:
+                return None
+            return self._free.popleft()
+
+    def commit(self, slot):
+        with self._condition:
+            self._commit_times[slot] = time.monotonic()
+            self._queue.append(slot)
+            statistics = self.statistics
+            statistics.produced += 1
+            statistics.depth = len(self._queue)
+            statistics.max_depth = max(statistics.max_depth, statistics.depth)
+            self._condition.notify_all()
+
+    def take(self, timeout=None):
+        """Index of the oldest committed slot, None on time out or if the
+        ring has been closed.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._queue or self._closed,
+                                     timeout)
+            if self._closed or not self._queue:
+                return None
+            slot = self._queue.popleft()
+            self.statistics.depth = len(self._queue)
+            return slot
+
+    def release(self, slot):
+        with self._condition:
+            statistics = self.statistics
+            statistics.latency = time.monotonic() - self._commit_times[slot]
+            statistics.consumed += 1
+            statistics.mean_latency += \
+                (statistics.latency - statistics.mean_latency) \
+                / statistics.consumed
+            statistics.max_latency = \
+                max(statistics.max_latency, statistics.latency)
+            self._free.append(slot)
+            self._condition.notify_all()
+
+    def close(self):
+        """Wakes up and stops producer and consumer."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class BlockPool:
+    """Preallocated blocks handed out by acquire and given back by release
+    once the consumer is done with them, steady state acquisition then
+    doesn't allocate any block memory.
+    """
+
+    def __init__(self, n_blocks, block_size, dtype=np.uint16):
+        self.blocks = np.empty((n_blocks, block_size), dtype=dtype)
+        self._free = deque(range(n_blocks))
+        self._condition = Condition()
+
+    @property
+    def block_size(self):
+        return self.blocks.shape[1]
+
+    @property
+    def available(self):
+        return len(self._free)
+
+    def acquire(self, timeout=None):
+        """A free block, None on time out"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._free, timeout):
+                return None
+            return self.blocks[self._free.popleft()]
+
+    def release(self, block):
+        index, remainder = divmod(block.ctypes.data - self.blocks.ctypes.data,
+                                  self.blocks.strides[0])
+        if remainder or not 0 <= index < len(self.blocks):
+            raise ValueError("BlockPool: block not from this pool")
+        with self._condition:
+            self._free.append(index)
+            self._condition.notify()
@@ -0,0 +1,143 @@
+""" Timers and counters for the stages of the processing chain (grab,
+dark, whitelight, TA, dark subtraction, acceptance check, export, ...).
+
+Set the environment variable TA_INSTRUMENTATION=1 to enable it. It is read
+at import: disabled, the timed decorator returns the function unchanged,
+production code doesn't pay anything.
+
+    from pymodaq_plugins_transient_absorption.instrumentation import timed
+
+    @timed('dark')
+    def process_dark(self, raw_data): ...
+"""
+import os
+import time
+import functools
+import numpy as np
+from threading import Lock
+
+
+class Stage:
+    """Call count, total time and the last history_size durations (ns) of
+    a stage, recording is O(1).
+    """
+
+    history_size = 1024
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total_ns = 0
+        self.durations = np.zeros(self.history_size, dtype=np.int64)
+        self._lock = Lock()
+
+    def record(self, duration_ns):
+        with self._lock:
+            self.durations[self.count % self.history_size] = duration_ns
+            self.count += 1
+            self.total_ns += duration_ns
+
+    def recent(self):
+        """Durations (ns) of the last calls, oldest not necessarily first"""
+        with self._lock:
+            return self.durations[:min(self.count, self.history_size)].copy()
+
+    def summary(self):
+        """count, mean, median and 99th percentile of the recent calls
+        (us)
+        """
+        recent = self.recent() / 1000
+        if not len(recent):
+            return self.count, 0., 0., 0.
+        median, p99 = np.percentile(recent, [50, 99])
+        return self.count, recent.mean(), median, p99
+
+    def histogram(self, bins=20):
+        """Counts of the recent durations (us) in log spaced bins"""
+        recent = self.recent() / 1000
+        if not len(recent):
+            return np.zeros(bins, dtype=np.int64), np.zeros(bins + 1)
+        low, high = max(recent.min(), 1e-3), max(recent.max(), 1e-3)
+        edges = np.geomspace(low, high * (1 + 1e-9), bins + 1)
+        return np.histogram(recent, edges)[0], edges
+
+
+class Instrumentation:
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {}
+        self._lock = Lock()
+
+    def stage(self, name):
+        with self._lock:
+            if name not in self.stages:
+                self.stages[name] = Stage(name)
+            return self.stages[name]
+
+    def timed(self, name):
+        """Decorator recording the duration of every call as stage name,
+        no-op if disabled.
+        """
+        def decorator(function):
+            if not self.enabled:
+                return function
+            stage = self.stage(name)
+            clock = time.perf_counter_ns
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = clock()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    stage.record(clock() - start)
+            return wrapper
+        return decorator
+
+    def count(self, name, duration_ns=0):
+        """Records an event, for code which isn't a function of its own"""
+        if self.enabled:
+            self.stage(name).record(duration_ns)
+
+    def clear(self):
+        with self._lock:
+            self.stages = {}
+
+    def summary(self):
+        """{ stage: (count, mean, median, p99 in us) }"""
+        return { name: stage.summary()
+                 for name, stage in list(self.stages.items()) }
+
+    def to_dte(self, bins=20):
+        """Mean, median and 99th percentile (us) and count of every stage as
+        0D data and the histogram of its recent durations as 1D data,
+        channels for viewers.
+        """
+        # not at module level, the controller and worker processes don't
+        # need pymodaq
+        from pymodaq.utils.data import DataFromPlugins, DataToExport, Axis
+        data = []
+        for name, stage in list(self.stages.items()):
+            count, mean, median, p99 = stage.summary()
+            data.append(
+                DataFromPlugins(name=name,
+                                data=[np.array([value]) for value in
+                                      (mean, median, p99, count)],
+                                dim='Data0D',
+                                labels=['mean us', 'median us', 'p99 us',
+                                        'count']))
+            counts, edges = stage.histogram(bins)
+            centers = np.sqrt(edges[:-1] * edges[1:])
+            data.append(
+                DataFromPlugins(name=name + ' histogram',
+                                data=[counts.astype(np.float64)],
+                                dim='Data1D', labels=['calls'],
+                                axes=[Axis(data=centers, label='duration',
+                                           units='us', index=0)]))
+        return DataToExport(name='instrumentation', data=data)
+
+
+instrumentation = \
+    Instrumentation(os.environ.get('TA_INSTRUMENTATION', '') not in ['', '0'])
+timed = instrumentation.timed
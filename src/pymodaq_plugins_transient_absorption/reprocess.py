@@ -0,0 +1,196 @@
+""" Offline reprocessing of a raw archive (see hardware/raw_archive) without
+GUI: dark, whitelight and TA acquisition are replayed through TAProcessor,
+delay points are processed in parallel worker processes and the TA matrix
+(delay x pixel) is written to HDF5. Several values of limit_diff_ta and of
+the min. samples of the whitelight statistics can be given, every
+combination is processed, for tuning the acceptance thresholds. The dark is
+taken once, the whitelight references once per min. samples, only the TA
+is processed per combination.
+
+    python -m pymodaq_plugins_transient_absorption.reprocess run.raw ta.h5 \
+        --statistics 100-200,300-400 --limit-diff-ta 2 3 5
+"""
+import argparse
+import itertools
+import multiprocessing
+import h5py
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from pymodaq_plugins_transient_absorption.ta_processor import TAProcessor, \
+    TACondition
+from pymodaq_plugins_transient_absorption.hardware.raw_archive import \
+    RawArchive
+
+
+def parse_ranges(text):
+    return [[int(pix) for pix in item.split('-')]
+            for item in text.split(',') if item.strip()]
+
+
+def make_processor(n_pix, condition, ranges, with_scatter, engine):
+    processor = TAProcessor()
+    processor.set_up(n_pix, condition, ranges, with_scatter,
+                     averager_engine=engine, dark_engine='integer')
+    return processor
+
+
+def run_until_idle(processor, archive, indices, name):
+    """Processes blocks until the processor is done, raises if it didn't
+    succeed.
+    """
+    result = None
+    for _, _, store in processor.process_archive(archive, indices):
+        result = store
+    if not result:
+        raise RuntimeError("reprocess: %s acquisition didn't converge with "
+                           "%d blocks" % (name, len(indices)))
+
+
+def process_dark(archive, n_pix, condition, ranges, with_scatter, engine):
+    """Dark signal and reference of the archive"""
+    processor = make_processor(n_pix, condition, ranges, with_scatter,
+                               engine)
+    run_until_idle(processor, archive, archive.select(pump=False, probe=False),
+                   'dark')
+    return processor.dark_signal, processor.dark_reference
+
+
+def process_references(archive, n_pix, condition, ranges, with_scatter,
+                       engine, dark):
+    """Whitelight references of the archive, their limit is
+    condition.limit_diff_ta
+    """
+    processor = make_processor(n_pix, condition, ranges, with_scatter,
+                               engine)
+    processor.set_dark(*dark)
+    processor.data_processing_mode = TAProcessor.WHITELIGHT
+    run_until_idle(processor, archive, archive.select(pump=False, probe=True),
+                   'whitelight')
+    return processor.whitelight_references
+
+
+def process_delay(archive, indices, n_pix, condition, ranges, with_scatter,
+                  engine, dark, references):
+    """TA of the blocks given by indices, runs in a worker process"""
+    processor = make_processor(n_pix, condition, ranges, with_scatter,
+                               engine)
+    processor.set_dark(*dark)
+    processor.set_whitelight_references(references)
+    processor.data_processing_mode = TAProcessor.TA
+    for _ in processor.process_archive(archive, indices):
+        pass
+    averager = processor.ta_averager
+    if averager.samples < 2:
+        mean = rms = np.full(n_pix, np.nan)
+    else:
+        mean, rms = averager.mean, averager.rms
+    return mean, rms, averager.samples, processor.whitelight_checker.checked
+
+
+def reprocess(path, output, condition, ranges, limits_diff_ta=None,
+              min_samples=None, engine='sums', workers=None):
+    """Processes the archive at path for every combination of
+    limits_diff_ta and min_samples (defaults from condition) and writes
+    one TA matrix per combination to output, in groups ta (single
+    combination) or ta_0, ta_1, ... with the settings as attributes.
+    workers = 0 processes in the calling process.
+    """
+    archive = RawArchive(path)
+    n_pix = int(archive.index['n_pixels'][0])
+    with_scatter = bool(archive.index['with_scatter'][0])
+    ta_blocks = archive.groups('delay')
+    for delay in list(ta_blocks):
+        ta_blocks[delay] = \
+            np.intersect1d(ta_blocks[delay], archive.select(pump=True,
+                                                            probe=True))
+        if not len(ta_blocks[delay]):
+            del ta_blocks[delay]
+    delays = sorted(ta_blocks)
+
+    settings = list(itertools.product(
+        limits_diff_ta or [condition.limit_diff_ta],
+        min_samples or [condition.min_white]))
+    dark = process_dark(archive, n_pix, condition, ranges, with_scatter,
+                        engine)
+    references = {}
+    for min_white in dict.fromkeys(min_white for _, min_white in settings):
+        references[min_white] = \
+            process_references(archive, n_pix,
+                               replace(condition, min_white=min_white),
+                               ranges, with_scatter, engine, dark)
+    executor = None if workers == 0 else \
+        ProcessPoolExecutor(workers,
+                            mp_context=multiprocessing.get_context('spawn'))
+    try:
+        with h5py.File(output, 'w') as file:
+            file.attrs['archive'] = archive.path
+            file['pixels'] = np.arange(n_pix)
+            for i,(limit_diff_ta, min_white) in enumerate(settings):
+                cond = replace(condition, limit_diff_ta=limit_diff_ta,
+                               min_white=min_white)
+                limited = [replace(reference, limit=limit_diff_ta)
+                           for reference in references[min_white]]
+                arguments = [(archive, ta_blocks[delay], n_pix, cond, ranges,
+                              with_scatter, engine, dark, limited)
+                             for delay in delays]
+                results = [process_delay(*args) for args in arguments] \
+                    if executor is None \
+                    else list(executor.map(process_delay, *zip(*arguments)))
+
+                group = file.create_group('ta' if len(settings) == 1
+                                          else 'ta_%d' % i)
+                group.attrs['limit_diff_ta'] = limit_diff_ta
+                group.attrs['min_samples'] = min_white
+                group['delay'] = np.array(delays, dtype=np.float64)
+                group['mean'] = np.array([result[0] for result in results])
+                group['rms'] = np.array([result[1] for result in results])
+                group['samples'] = [result[2] for result in results]
+                group['checked'] = [result[3] for result in results]
+                group['dark'] = np.stack(dark)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Reprocess a raw TA archive into an HDF5 TA matrix")
+    parser.add_argument('archive', help="raw archive (.raw)")
+    parser.add_argument('output', help="HDF5 output file")
+    parser.add_argument('--statistics', default='',
+                        help="statistic pixel ranges, e.g. 100-200,300-400")
+    parser.add_argument('--limit-diff-ta', type=float, nargs='+',
+                        default=[3], help="one or several whitelight "
+                        "acceptance limits")
+    parser.add_argument('--min-samples', type=int, nargs='+', default=[1000],
+                        help="one or several min. samples of the whitelight "
+                        "statistics")
+    parser.add_argument('--min-dark', type=int, default=1000)
+    parser.add_argument('--max-dark', type=int, default=100)
+    parser.add_argument('--max-white', type=int, default=10)
+    parser.add_argument('--limit-diff-rms', type=float, default=3,
+                        help="max. difference of rms, dark and whitelight")
+    parser.add_argument('--limit-diff-mean', type=float, default=3,
+                        help="max. difference of mean, dark and whitelight")
+    parser.add_argument('--engine', default='sums',
+                        choices=['sums', 'welford'],
+                        help="averager engine, darks are always summed up "
+                        "as integers")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="worker processes, 0 for none, default: "
+                        "number of CPUs")
+    args = parser.parse_args(argv)
+
+    condition = \
+        TACondition(args.limit_diff_rms, args.limit_diff_mean, args.min_dark,
+                    args.max_dark, args.limit_diff_rms, args.limit_diff_mean,
+                    args.min_samples[0], args.max_white,
+                    args.limit_diff_ta[0])
+    reprocess(args.archive, args.output, condition,
+              parse_ranges(args.statistics), args.limit_diff_ta,
+              args.min_samples, args.engine, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import time
+import numpy as np
+from threading import Lock
+from qtpy.QtCore import QRectF, QTimer
+from qtpy.QtWidgets import QWidget, QVBoxLayout
+import pyqtgraph as pg
+from pyqtgraph import GraphicsLayoutWidget, ImageItem
+from pymodaq_plugins_transient_absorption.ta_matrix import TAMatrix
+
+
+def minmax_factor(n, size):
+    """Group size for reducing n samples to at most size, each group
+    giving its minimum and maximum.
+    """
+    return 1 if n <= size else -(-2 * n // size)
+
+
+def decimate_minmax(data, factor, axis=-1):
+    """Minimum and maximum of every group of factor samples along axis,
+    interleaved, so that narrow peaks survive the reduction. NaN only
+    counts if a group has nothing else.
+    """
+    if factor == 1:
+        return data
+    data = np.moveaxis(data, axis, -1)
+    n = data.shape[-1]
+    groups = -(-n // factor)
+    padded = np.full(data.shape[:-1] + (groups * factor,), np.nan)
+    padded[..., :n] = data
+    padded = padded.reshape(data.shape[:-1] + (groups, factor))
+    result = np.empty(data.shape[:-1] + (groups, 2))
+    np.fmin.reduce(padded, axis=-1, out=result[..., 0])
+    np.fmax.reduce(padded, axis=-1, out=result[..., 1])
+    return np.moveaxis(result.reshape(data.shape[:-1] + (2 * groups,)), -1,
+                       axis)
+
+
+class TAMapViewer(QWidget):
+    """Delay x pixel map of a TAMatrix with kinetics at selected pixels.
+    update_rows only marks rows as changed and may be called from any
+    thread, a timer renders at most frame_rate times per second and only
+    recomputes the changed rows. The image is reduced to the size of the
+    view with min/max decimation, delays are shown by index which keeps
+    log scans readable. Fed by a DelayScan with the matrix shown as its
+    matrix and update_point as its callback.
+    """
+
+    frame_rate = 10
+
+    def __init__(self, parent=None):
+        QWidget.__init__(self, parent)
+        layout = QVBoxLayout()
+        self.graphics = GraphicsLayoutWidget()
+        layout.addWidget(self.graphics)
+        self.setLayout(layout)
+
+        self.map_plot = self.graphics.addPlot(row=0, col=0)
+        self.map_plot.setLabel('left', 'delay index')
+        self.map_plot.setLabel('bottom', 'pixel')
+        self.image = ImageItem()
+        self.image.setColorMap(pg.colormap.get('CET-D1'))
+        self.map_plot.addItem(self.image)
+        self.kinetics_plot = self.graphics.addPlot(row=1, col=0)
+        self.kinetics_plot.setLabel('bottom', 'delay')
+        self.kinetics_plot.addLegend()
+        self.map_plot.vb.sigResized.connect(self.resized)
+
+        self.matrix = None
+        self.corrected = False
+        self.pixels = []
+        self.curves = []
+        self.kinetics = None
+        self.display_size = None
+        self.render_time = 0
+        self.frames = 0
+        self._display = None
+        self._level = 0
+        self._dirty = set()
+        self._full = False
+        self._lock = Lock()
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.render)
+        self.set_frame_rate(self.frame_rate)
+
+    def set_frame_rate(self, frame_rate):
+        self.frame_rate = frame_rate
+        self.timer.start(int(1000 / frame_rate))
+
+    def set_matrix(self, matrix: TAMatrix, corrected=False):
+        """Shows matrix, corrected: its chirp corrected view"""
+        self.matrix = matrix
+        self.corrected = corrected
+        self.set_pixels(self.pixels)
+
+    def set_pixels(self, pixels):
+        """Pixels (column indices) whose kinetics are shown"""
+        self.pixels = list(pixels)
+        self.kinetics_plot.clear()
+        self.curves = [self.kinetics_plot.plot(pen=(i, len(self.pixels)),
+                                               name='pixel %d' % pixel)
+                       for i, pixel in enumerate(self.pixels)]
+        if self.matrix is not None:
+            self.kinetics = np.full((len(self.pixels), self.matrix.shape[0]),
+                                    np.nan)
+        self.redraw()
+
+    def set_display_size(self, width, height):
+        """Size in screen pixels the map is decimated to, default: the
+        size of the view.
+        """
+        self.display_size = (width, height)
+        self.redraw()
+
+    def resized(self):
+        if self.display_size is None:
+            self.redraw()
+
+    def redraw(self):
+        with self._lock:
+            self._full = True
+
+    def update_rows(self, rows):
+        with self._lock:
+            self._dirty.update(rows)
+
+    def update_point(self, point):
+        """Callback for DelayScan, the point is already in the matrix"""
+        self.update_rows([self.matrix.index(point.delay)])
+
+    def layout_image(self):
+        """Decimation factors and display buffer for the current size"""
+        n_rows, n_pix = self.matrix.shape
+        if self.display_size is None:
+            rect = self.map_plot.vb.rect()
+            width, height = int(rect.width()), int(rect.height())
+        else:
+            width, height = self.display_size
+        self.column_factor = minmax_factor(n_pix, max(width, 2))
+        self.row_factor = minmax_factor(n_rows, max(height, 2))
+        n_columns = len(decimate_minmax(np.zeros(n_pix), self.column_factor))
+        n_display_rows = \
+            len(decimate_minmax(np.zeros(n_rows), self.row_factor))
+        self._display = np.full((n_display_rows, n_columns), np.nan)
+        self._level = 0
+        x_axis = self.matrix.x_axis
+        self.image.setRect(QRectF(x_axis[0], 0, x_axis[-1] - x_axis[0],
+                                  n_rows))
+
+    def render(self):
+        with self._lock:
+            rows, self._dirty = self._dirty, set()
+            full, self._full = self._full, False
+        if self.matrix is None or not (rows or full):
+            return
+        start = time.perf_counter()
+        if full or self._display is None:
+            self.layout_image()
+            rows = range(self.matrix.shape[0])
+        elif self.corrected: # the chirp correction mixes all rows
+            rows = range(self.matrix.shape[0])
+        source = self.matrix.corrected if self.corrected else self.matrix.mean
+
+        factor = self.row_factor
+        for group in sorted({row // factor for row in rows}):
+            block = decimate_minmax(source[group * factor:
+                                           (group + 1) * factor],
+                                    self.column_factor, axis=1)
+            if factor == 1:
+                self._display[group] = block[0]
+            else:
+                np.fmin.reduce(block, axis=0, out=self._display[2 * group])
+                np.fmax.reduce(block, axis=0,
+                               out=self._display[2 * group + 1])
+            with np.errstate(invalid='ignore'):
+                level = np.nanmax(np.abs(block), initial=0)
+            self._level = max(self._level, level)
+        level = self._level or 1
+        self.image.setImage(self._display.T, autoLevels=False,
+                            levels=(-level, level))
+
+        if self.kinetics is not None:
+            rows = np.fromiter(rows, dtype=np.int64)
+            delays = self.matrix.delays
+            for i, (pixel, curve) in enumerate(zip(self.pixels, self.curves)):
+                self.kinetics[i, rows] = source[rows, pixel]
+                curve.setData(delays, self.kinetics[i], connect='finite')
+
+        self.render_time = time.perf_counter() - start
+        self.frames += 1
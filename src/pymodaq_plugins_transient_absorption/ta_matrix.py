@@ -0,0 +1,244 @@
+import numpy as np
+from dataclasses import dataclass
+from threading import RLock
+
+
+class TAMatrix:
+    """TA of a delay scan as preallocated (delays, n_pix) arrays of mean,
+    M2 and sample counts. A row is updated in place when its delay is done,
+    the scan in progress is kept apart from the previous scans, which are
+    merged weighted by their samples. Updating a delay again within a scan
+    (e.g. a refined point) replaces its contribution. Counts are per pixel,
+    pixels without TA (NaN) don't count.
+
+    The chirp corrected view, every pixel column interpolated to delays
+    relative to its time zero, is computed on first access after a change
+    and cached.
+    """
+
+    def __init__(self, delays, n_pix, x_axis=None):
+        self.delays = np.asarray(delays, dtype=np.float64)
+        self.n_pix = n_pix
+        self.x_axis = np.arange(n_pix, dtype=np.float64) if x_axis is None \
+            else np.asarray(x_axis, dtype=np.float64)
+        shape = (len(self.delays), n_pix)
+        # merged result of all scans, what is displayed and exported
+        self.mean = np.full(shape, np.nan)
+        self.m2 = np.zeros(shape)
+        self.counts = np.zeros(shape, dtype=np.int64)
+        # finished scans and the scan in progress
+        self._done = [np.zeros(shape), np.zeros(shape),
+                      np.zeros(shape, dtype=np.int64)]
+        self._scan = [np.zeros(shape), np.zeros(shape),
+                      np.zeros(shape, dtype=np.int64)]
+        self.scans = 0
+        self.chirp_coefficients = None
+        self._corrected = None
+        self._index = { delay: i for i, delay in enumerate(self.delays) }
+        self._lock = RLock()
+
+    @property
+    def shape(self):
+        return self.mean.shape
+
+    @property
+    def rms(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.m2 / (self.counts - 1))
+
+    def index(self, delay):
+        return self._index[delay]
+
+    def update(self, index, mean, rms, samples):
+        """Sets the TA of row index for the current scan and updates the
+        merged row.
+        """
+        mean = np.asarray(mean, dtype=np.float64)
+        valid = np.isfinite(mean) & np.isfinite(rms)
+        counts = np.where(valid, samples, 0)
+        with self._lock:
+            scan_mean, scan_m2, scan_counts = self._scan
+            scan_mean[index] = np.where(valid, mean, 0)
+            scan_m2[index] = np.where(valid, np.square(rms) * (samples - 1),
+                                      0)
+            scan_counts[index] = counts
+            self.merge_row(index)
+            self._corrected = None
+
+    def update_point(self, point):
+        """Update from a ScanPoint of delay_scan"""
+        self.update(self.index(point.delay), point.mean, point.rms,
+                    point.samples)
+
+    def merge_row(self, index):
+        counts, mean, m2 = \
+            self.merge(*(a[index] for a in self._done + self._scan))
+        self.counts[index] = counts
+        self.mean[index] = np.where(counts > 0, mean, np.nan)
+        self.m2[index] = m2
+
+    @staticmethod
+    def merge(mean_a, m2_a, counts_a, mean_b, m2_b, counts_b):
+        """WelfordAverager.merge for pixels which may have no samples"""
+        counts = counts_a + counts_b
+        weight = np.divide(counts_b, counts, out=np.zeros(counts.shape),
+                           where=counts > 0)
+        delta = mean_b - mean_a
+        mean = mean_a + delta * weight
+        m2 = m2_a + m2_b + delta**2 * counts_a * weight
+        return counts, mean, m2
+
+    def end_scan(self):
+        """Adds the current scan to the finished ones"""
+        with self._lock:
+            np.copyto(self._done[0], np.nan_to_num(self.mean))
+            np.copyto(self._done[1], self.m2)
+            np.copyto(self._done[2], self.counts)
+            for scan in self._scan:
+                scan.fill(0)
+            self.scans += 1
+
+    def set_chirp(self, coefficients):
+        """Time zero per pixel as polynomial of the x axis, coefficients
+        highest power first as for np.polyval, None for no correction.
+        """
+        with self._lock:
+            self.chirp_coefficients = None if coefficients is None \
+                else np.asarray(coefficients, dtype=np.float64)
+            self._corrected = None
+
+    @property
+    def time_zero(self):
+        if self.chirp_coefficients is None:
+            return np.zeros(self.n_pix)
+        return np.polyval(self.chirp_coefficients, self.x_axis)
+
+    @property
+    def corrected(self):
+        """Mean, shape (delays, n_pix), interpolated to delays relative to
+        the time zero of each pixel, NaN outside of the measured delays.
+        """
+        with self._lock:
+            if self._corrected is None:
+                self._corrected = self.correct_chirp()
+            return self._corrected
+
+    def correct_chirp(self):
+        if self.chirp_coefficients is None:
+            return self.mean.copy()
+        corrected = np.full(self.shape, np.nan)
+        order = np.argsort(self.delays)
+        delays = self.delays[order]
+        for pixel, time_zero in enumerate(self.time_zero):
+            column = self.mean[order, pixel]
+            measured = np.isfinite(column)
+            if np.count_nonzero(measured) < 2:
+                continue
+            corrected[order, pixel] = \
+                np.interp(delays + time_zero, delays[measured],
+                          column[measured], left=np.nan, right=np.nan)
+        return corrected
+
+    def save(self, group):
+        """Writes the matrix into an h5py group or file"""
+        with self._lock:
+            group['delay'] = self.delays
+            group['pixels'] = self.x_axis
+            group['mean'] = self.mean
+            group['rms'] = self.rms
+            group['counts'] = self.counts
+            group.attrs['scans'] = self.scans
+            if self.chirp_coefficients is not None:
+                group.attrs['chirp'] = self.chirp_coefficients
+
+
+@dataclass
+class ScanRecord:
+
+    scan: int
+    deviation: float # median |z| scaled to sigma, NaN without enough scans
+    rejected: bool
+
+
+class ScanAccumulator(TAMatrix):
+    """TAMatrix for repeated scans which drops outlier scans. For every
+    delay and pixel mean and M2 of the scan means of the accepted scans are
+    kept. At the end of a scan every measured element gives z = (scan mean
+    - mean of the scans) / sqrt(variance of the scan means * (1 + 1 / scans)
+    + squared standard error of the scan), the variance of the difference
+    including the error of the mean of the scans. The scan's own error
+    keeps z sane while the spread of only a few scans is poorly known. The
+    deviation, the median of |z| scaled to sigma of a normal distribution,
+    is compared with n_sigma once min_scans scans are accepted, a deviating
+    scan isn't merged. Memory doesn't grow with the number of scans, only a
+    ScanRecord per scan is kept.
+    """
+
+    def __init__(self, delays, n_pix, x_axis=None, n_sigma=3, min_scans=5,
+                 reject=True):
+        super().__init__(delays, n_pix, x_axis)
+        self.n_sigma = n_sigma
+        self.min_scans = min_scans
+        self.reject = reject
+        self.scan_means = np.zeros(self.shape)
+        self.scan_m2 = np.zeros(self.shape)
+        self.n_scans = np.zeros(self.shape, dtype=np.int64)
+        self.records = []
+
+    @property
+    def accepted(self):
+        return sum(not record.rejected for record in self.records)
+
+    @property
+    def rejected(self):
+        return [record.scan for record in self.records if record.rejected]
+
+    def deviation(self):
+        """Deviation of the current scan from the accepted ones"""
+        mean, m2, counts = self._scan
+        measured = (counts > 1) & (self.n_scans >= 2)
+        counts = counts[measured]
+        n_scans = self.n_scans[measured]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = self.scan_m2[measured] / (n_scans - 1) \
+                * (1 + 1 / n_scans) + m2[measured] / (counts - 1) / counts
+            z = (mean[measured] - self.scan_means[measured]) \
+                / np.sqrt(variance)
+        z = z[np.isfinite(z)]
+        return np.median(np.abs(z)) / 0.6745 if len(z) else np.nan
+
+    def end_scan(self):
+        """Merges the current scan unless it deviates, see ScanRecord"""
+        with self._lock:
+            deviation = self.deviation() \
+                if self.accepted >= self.min_scans else np.nan
+            rejected = bool(self.reject and deviation > self.n_sigma)
+            self.records.append(ScanRecord(len(self.records), deviation,
+                                           rejected))
+            if rejected:
+                self.drop_scan()
+                return
+
+            mean, _, counts = self._scan
+            measured = counts > 0
+            self.n_scans += measured
+            delta = np.where(measured, mean - self.scan_means, 0)
+            self.scan_means += np.divide(delta, self.n_scans,
+                                         out=np.zeros(self.shape),
+                                         where=self.n_scans > 0)
+            self.scan_m2 += delta * np.where(measured,
+                                             mean - self.scan_means, 0)
+            super().end_scan()
+
+    def drop_scan(self):
+        """Discards the current scan, the merged matrix is the one of the
+        finished scans again.
+        """
+        with self._lock:
+            done_mean, done_m2, done_counts = self._done
+            self.mean[:] = np.where(done_counts > 0, done_mean, np.nan)
+            self.m2[:] = done_m2
+            self.counts[:] = done_counts
+            for scan in self._scan:
+                scan.fill(0)
+            self._corrected = None
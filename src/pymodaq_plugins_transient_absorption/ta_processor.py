@@ -1,9 +1,11 @@
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from PyQt5.QtCore import QObject, pyqtSignal
 from pymodaq.utils.data import DataFromPlugins, DataToExport, Axis
 from pymodaq_plugins_transient_absorption.averager import Averager, \
     AveragerFactory
+from pymodaq_plugins_transient_absorption.instrumentation import timed
 
 
 @dataclass
@@ -45,11 +47,62 @@ class WhitelightReference:
         self.len = len(self.ref_data)
 
     def check(self, whitelight):
-        wl = whitelight[self.from_pixel:self.from_pixel+self.len]
-        diff_rms = sum(abs((wl - self.ref_data) / self.rms_data))
+        """Works as well for a stack of whitelights, shape (..., n_pix)"""
+        wl = whitelight[..., self.from_pixel:self.from_pixel+self.len]
+        diff_rms = np.sum(abs((wl - self.ref_data) / self.rms_data), axis=-1)
         return diff_rms < self.limit * self.len
 
 
+class WhitelightChecker:
+    """All whitelight references compiled into one padded matrix, checks
+    every range for every item of a block in one vectorized call. Padding
+    pixels have zero inverse rms and don't contribute.
+    """
+
+    def __init__(self, references: [WhitelightReference]):
+        self.n_ranges = len(references)
+        width = max([ref.len for ref in references], default=0)
+        self.pixels = np.zeros((self.n_ranges, width), dtype=np.intp)
+        self.ref_data = np.zeros((self.n_ranges, width))
+        self.inverse_rms = np.zeros((self.n_ranges, width))
+        self.limits = np.array([ref.limit * ref.len for ref in references],
+                               dtype=np.float64)
+        for i,ref in enumerate(references):
+            self.pixels[i, :ref.len] = \
+                np.arange(ref.from_pixel, ref.from_pixel + ref.len)
+            self.ref_data[i, :ref.len] = ref.ref_data
+            with np.errstate(divide='ignore'):
+                self.inverse_rms[i, :ref.len] = 1 / np.asarray(ref.rms_data)
+        self.clear()
+
+    def clear(self):
+        self.checked = 0
+        self.rejected = np.zeros(self.n_ranges, dtype=np.int64)
+
+    def check_ranges(self, whitelights):
+        """Acceptance per item and range for whitelights of shape
+        (items, channels, n_pix), all channels of an item have to pass.
+        """
+        wl = whitelights[..., self.pixels]
+        with np.errstate(invalid='ignore'):
+            diff_rms = np.einsum('...rw,rw->...r', abs(wl - self.ref_data),
+                                 self.inverse_rms)
+            return np.all(diff_rms < self.limits, axis=1)
+
+    def check(self, whitelights):
+        """Boolean acceptance mask per item, rejections are counted per
+        range.
+        """
+        passed = self.check_ranges(whitelights)
+        self.checked += len(passed)
+        self.rejected += len(passed) - np.count_nonzero(passed, axis=0)
+        return np.all(passed, axis=1)
+
+    @property
+    def rejection_rates(self):
+        return self.rejected / max(1, self.checked)
+
+
 class TAProcessor(QObject):
     """ 
     """
@@ -63,8 +116,19 @@ class TAProcessor(QObject):
     TA         = 3
 
     def set_up(self, n_pix, cond: TACondition, statistic_ranges: [],
-               with_scatter: bool):
+               with_scatter: bool, averager_engine='sums',
+               statistics_threads=0, convergence=Averager.BLOCKS,
+               dark_engine=None, ta_ranges=None):
+        """dark_engine, if given, replaces averager_engine for the raw
+        dark data, e.g. 'integer' for uint16 camera data. ta_ranges are
+        the pixel ranges whose TA error is compared with cond.max_ta_rms,
+        default is the whole spectrum.
+        """
         self.n_pix = n_pix
+        self.averager_engine = averager_engine
+        self.dark_engine = dark_engine or averager_engine
+        self.convergence = convergence
+        self.set_up_thread_pool(statistics_threads)
         data_x_axis = np.linspace(0, self.n_pix - 1, self.n_pix)
         self.x_axis = Axis(data=data_x_axis, label='pixels', units='', index=0)
         self.with_scatter = with_scatter
@@ -81,14 +145,48 @@ class TAProcessor(QObject):
         self.whitelight_conditions.append(StatisticsCondition(0, n_pix))
 
         self.dark_averagers = \
-            [AveragerFactory.make(self.dark_condition, 2 * n_pix),
-             AveragerFactory.make(self.dark_condition, 2 * n_pix, n_pix)]
+            [self.make_averager(self.dark_condition, 2 * n_pix,
+                                engine=self.dark_engine),
+             self.make_averager(self.dark_condition, 2 * n_pix, n_pix,
+                                engine=self.dark_engine)]
         self.whitelight_averagers = []
         self.ta_averager = \
-            AveragerFactory.make(StatisticsCondition(0, n_pix), n_pix)
+            self.make_averager(StatisticsCondition(0, n_pix), n_pix)
         self.limit_diff_ta = cond.limit_diff_ta
+        self.max_ta = cond.max_ta
+        self.max_ta_rms = cond.max_ta_rms
+        self.ta_ranges = ta_ranges or [[0, n_pix]]
+        self.ta_blocks = 0
+        self.ta_converged = False
+        self.dark_template = None
+        self._dark_subtracted = None
+        self.whitelight_checker = None
+        self.ta_whitelight_averager = None
         self.data_processing_mode = self.DARK
 
+    def make_averager(self, condition, stride, offset=0, engine=None):
+        return AveragerFactory.make(condition, stride, offset,
+                                    engine=engine or self.averager_engine,
+                                    convergence=self.convergence)
+
+    def set_up_thread_pool(self, n_threads):
+        """With more than one thread the whitelight averagers of the
+        statistics ranges are updated concurrently.
+        """
+        if getattr(self, 'statistics_threads', None) == n_threads:
+            return
+        self.close()
+        self.statistics_threads = n_threads
+        self.thread_pool = \
+            ThreadPoolExecutor(n_threads, thread_name_prefix='statistics') \
+            if n_threads > 1 else None
+
+    def close(self):
+        if getattr(self, 'thread_pool', None) is not None:
+            self.thread_pool.shutdown()
+        self.thread_pool = None
+        self.statistics_threads = None
+
     def reset(self):
         for av in self.dark_averagers + self.whitelight_averagers:
             av.reset()
@@ -97,6 +195,11 @@ class TAProcessor(QObject):
 
     def clear_accumulation(self):
         self.ta_averager.reset()
+        self.ta_blocks = 0
+        self.ta_converged = False
+        if self.whitelight_checker is not None:
+            self.whitelight_checker.clear()
+            self.ta_whitelight_averager.reset()
         if len(self.whitelight_averagers):
             self.whitelight_averagers[-1].reset()
 
@@ -104,23 +207,19 @@ class TAProcessor(QObject):
         current = None
         if self.data_processing_mode == self.DARK:
             result, dte = self.process_dark(raw_data)
-            if result == Averager.SUCCESS:
-                self.whitelight_averagers = \
-                    [AveragerFactory.make(cond, 2 * self.n_pix, self.n_pix)
-                     for cond in self.whitelight_conditions]
             self.dark_signal = self.dark_averagers[0].mean
             self.dark_reference = self.dark_averagers[1].mean
+            self.dark_template = None
+            if result == Averager.SUCCESS:
+                self.set_dark(self.dark_signal, self.dark_reference)
 
         elif self.data_processing_mode == self.WHITELIGHT:
             result, dte = self.process_whitelight(raw_data)
             if result == Averager.SUCCESS:
-                self.whitelight_references = \
+                self.set_whitelight_references(
                     [WhitelightReference(av.mean, av.rms, av.start,
                                          self.limit_diff_ta)
-                     for av in self.whitelight_averagers[:-2]]
-                self.ta_whitelight_averager = \
-                    AveragerFactory.make(self.whitelight_conditions[-1],
-                                         2 * self.n_pix, self.n_pix)
+                     for av in self.whitelight_averagers[:-2]])
 
         elif self.data_processing_mode == self.TA:
             result, dte = self.process_ta(raw_data)
@@ -140,6 +239,41 @@ class TAProcessor(QObject):
 
         return dte, False # display only
 
+    def set_dark(self, signal, reference):
+        """Takes a dark, measured or known from a previous run, and
+        prepares the whitelight acquisition.
+        """
+        self.dark_signal = signal
+        self.dark_reference = reference
+        self.make_dark_template()
+        self.whitelight_averagers = \
+            [self.make_averager(cond, 2 * self.n_pix, self.n_pix)
+             for cond in self.whitelight_conditions]
+
+    def set_whitelight_references(self, references: [WhitelightReference]):
+        """Takes the whitelight references and prepares the TA acquisition"""
+        self.whitelight_references = references
+        self.whitelight_checker = WhitelightChecker(references)
+        self.ta_whitelight_averager = \
+            self.make_averager(self.whitelight_conditions[-1],
+                               2 * self.n_pix, self.n_pix)
+
+    def process_archive(self, archive, indices=None):
+        """Processes blocks of a raw archive (views into its memory map) and
+        yields block index, data to export and store flag per block. Stops
+        when the processor becomes idle.
+        """
+        for i in range(len(archive)) if indices is None else indices:
+            if archive.index['with_scatter'][i] != self.with_scatter \
+               or archive.index['n_pixels'][i] != self.n_pix:
+                raise ValueError("TAProcessor: archive block %d doesn't "
+                                 "match the processor set up" % i)
+            dte, store = self.process_data(archive.block(i))
+            yield i, dte, store
+            if self.data_processing_mode == self.IDLE:
+                break
+
+    @timed('dark')
     def process_dark(self, raw_data):
         result = Averager.SUCCESS
         for av in self.dark_averagers:
@@ -157,32 +291,73 @@ class TAProcessor(QObject):
         dte = DataToExport(name='dark', data=mean + rms)
         return result, dte
 
-    def subtrackt_dark(self, raw_data):
-        data_size = len(raw_data)
-        data = np.empty(data_size)
-        start = 0
-        end = self.n_pix
-        while start < data_size:
-            data[start:end] = raw_data[start:end] - self.dark_signal
-            start += self.n_pix
-            end += self.n_pix
-            data[start:end] = raw_data[start:end] - self.dark_reference
-            start += self.n_pix
-            end += self.n_pix
-        return data
+    def make_dark_template(self):
+        """Interleaved (2, n_pix) dark of signal and reference camera"""
+        self.dark_template = np.stack((self.dark_signal, self.dark_reference))
 
+    @timed('subtraction')
+    def subtrackt_dark(self, raw_data):
+        """Subtracts the dark from all complete items of raw_data with one
+        broadcast. The result, shape (items, 4 or 8, n_pix), is a view into
+        a buffer owned by the processor and reused for the next block.
+        """
+        channels = self.item_size // self.n_pix
+        n_items = len(raw_data) // self.item_size
+        shape = (n_items, channels // 2, 2, self.n_pix)
+        if self._dark_subtracted is None \
+           or self._dark_subtracted.shape != shape:
+            self._dark_subtracted = np.empty(shape)
+        if self.dark_template is None:
+            self.make_dark_template()
+        np.subtract(raw_data[:n_items * self.item_size].reshape(shape),
+                    self.dark_template, out=self._dark_subtracted)
+        return self._dark_subtracted.reshape(n_items, channels, self.n_pix)
+
+    def items_to_check(self, scans_per_item):
+        """Number of items all whitelight averagers can take before the
+        first of them checks its convergence.
+        """
+        items = None
+        for av in self.whitelight_averagers[:-1]:
+            samples = av.samples_to_check()
+            if samples is None:
+                continue
+            n = max(1, -(-samples // scans_per_item))
+            items = n if items is None else min(items, n)
+        if items is None and len(self.whitelight_averagers) < 2:
+            items = 1
+        return items
+
+    def take_whitelight(self, data):
+        """Feeds data to all whitelight averagers, concurrently if there is
+        a thread pool. Returns their results in averager order.
+        """
+        if self.thread_pool is None:
+            return [av.take_data(data) for av in self.whitelight_averagers]
+        return list(self.thread_pool.map(lambda av: av.take_data(data),
+                                         self.whitelight_averagers))
+
+    @timed('whitelight')
     def process_whitelight(self, raw_data):
-        src = 0
-        while src < len(raw_data):
-            dark_subtracted = \
-                self.subtrackt_dark(raw_data[src:src + self.item_size])
-            result = Averager.SUCCESS
-            for av in self.whitelight_averagers[:-1]:
-                result = max(result, av.take_data(dark_subtracted))
-            self.whitelight_averagers[-1].take_data(dark_subtracted)
+        """Items are fed in chunks ending where the next averager checks
+        its convergence, so the averagers stop at the same item as when
+        feeding item by item. The results are merged in averager order,
+        FAIL wins over CONTINUE wins over SUCCESS.
+        """
+        items = self.subtrackt_dark(raw_data)
+        scans_per_item = items.shape[1] // 2
+        result = Averager.CONTINUE
+        taken = 0
+        while taken < len(items):
+            chunk = self.items_to_check(scans_per_item)
+            if chunk is None or chunk > len(items) - taken:
+                chunk = len(items) - taken
+            results = \
+                self.take_whitelight(items[taken:taken + chunk].ravel())
+            taken += chunk
+            result = max(results[:-1], default=Averager.SUCCESS)
             if result != Averager.CONTINUE:
                 break
-            src += self.item_size
 
         mean = [DataFromPlugins(name='dark camera %d' % i, data=[av.mean],
                                 dim='Data1D', labels=['dark camera %d' % i],
@@ -200,50 +375,52 @@ class TAProcessor(QObject):
         
         diff = sum(abs((wl - reference) / rms)) / len(wl)
         
-    def check_item(self, data):
-        if self.with_scatter:
-            start = [1, 3, 5, 7]
-            end = [2, 4, 6, 8]
-        else:
-            start = [1, 3]
-            end = [2, 4]
-        for s,e in zip(np.array(start) * self.n_pix, np.array(end) * self.n_pix):
-            for ref in self.whitelight_references:
-                if not ref.check(data[s:e]):
-                    return False
-        return True
+    @timed('acceptance')
+    def check_items(self, items):
+        """Whitelight acceptance of all items, shape (items, channels, n_pix)
+        """
+        return self.whitelight_checker.check(items[:, 1::2])
 
+    @timed('ta')
     def process_ta(self, raw_data):
-        n_pix = self.n_pix
+        items = self.subtrackt_dark(raw_data)
+        n_items = len(items)
+
+        accepted = np.flatnonzero(self.check_items(items))
+        result = Averager.CONTINUE
         ta = None
-        src = 0
-        while src < len(raw_data):
-            data = self.subtrackt_dark(raw_data[src:src + self.item_size])
-            self.ta_whitelight_averager.take_data(data)
-            if self.check_item(data):
-                if self.with_scatter:
-                    data[:n_pix] -= data[4*n_pix:5*n_pix]
-                counter = data[:n_pix] * data[3*n_pix:4*n_pix]
-                denominator = data[n_pix:2*n_pix] * data[2*n_pix:3*n_pix]
-                condition = np.logical_and(counter > 0, denominator > 0)
-                ta = np.where(condition, -np.log10(counter / denominator), 0)
-                result = self.ta_averager.take_data(ta)
-                if result == Averager.SUCCESS:
-                    break
-            src += self.item_size
+        used_items = n_items
+        if len(accepted):
+            selected = items[accepted]
+            signal = selected[:, 0]
+            if self.with_scatter:
+                signal = signal - selected[:, 4]
+            counter = signal * selected[:, 3]
+            denominator = selected[:, 1] * selected[:, 2]
+            condition = np.logical_and(counter > 0, denominator > 0)
+            ta_values = np.zeros(counter.shape)
+            np.divide(counter, denominator, out=ta_values, where=condition)
+            np.log10(ta_values, out=ta_values, where=condition)
+            np.negative(ta_values, out=ta_values)
+            result, used = \
+                self.ta_averager.take_data_until_done(ta_values.ravel(),
+                                                      stop_on_fail=False)
+            ta = ta_values[used - 1]
+            if result == Averager.SUCCESS:
+                used_items = accepted[used - 1] + 1
+
+        self.ta_whitelight_averager.take_data(items[:used_items].ravel())
+        self.ta_blocks += 1
 
         if self.ta_whitelight_averager.samples < 2:
-            try:
-                return result, None
-            except:
-                return Averager.CONTINUE, None
+            return result, None
 
         white = DataFromPlugins(name='whitelight',
                                 data=[self.ta_whitelight_averager.mean],
                                 dim='Data1D', labels=['whitelight'],
                                 axes=[self.x_axis])
 
-        if ta is None or self.ta_averager.samples < 2:
+        if self.ta_averager.samples < 2:
             data = [white]
             result = Averager.CONTINUE
         else:
@@ -253,8 +430,35 @@ class TAProcessor(QObject):
             rms = DataFromPlugins(name='rms TA', data=[self.ta_averager.rms],
                                   dim='Data1D', labels=['rms TA'],
                                   axes=[self.x_axis])
-            ta = DataFromPlugins(name='current', data=[ta], dim='Data1D',
-                                 labels=['current'], axes=[self.x_axis])
-            data = [mean, rms, ta, white]
+            data = [mean, rms]
+            if ta is not None:
+                data.append(DataFromPlugins(name='current', data=[ta],
+                                            dim='Data1D', labels=['current'],
+                                            axes=[self.x_axis]))
+            data.append(white)
+
+        if result == Averager.CONTINUE:
+            result = self.check_ta_budget()
 
         return result, DataToExport(name='ta', data=data)
+
+    def ta_error(self, rms, samples):
+        """Largest mean standard error of the TA over the TA ranges"""
+        error = rms / np.sqrt(samples)
+        return max(np.mean(error[start:end]) for start, end in self.ta_ranges)
+
+    def check_ta_budget(self):
+        """SUCCESS once the TA error drops below max_ta_rms or, if there
+        is a TA at all, when max_ta blocks are taken, FAIL for no TA after
+        max_ta blocks. 0 disables either limit.
+        """
+        averager = self.ta_averager
+        if averager.samples >= 2 and self.max_ta_rms > 0 \
+           and self.ta_error(averager.rms, averager.samples) \
+               <= self.max_ta_rms:
+            self.ta_converged = True
+            return Averager.SUCCESS
+        if self.max_ta and self.ta_blocks >= self.max_ta:
+            return Averager.SUCCESS if averager.samples >= 2 \
+                else Averager.FAIL
+        return Averager.CONTINUE
@@ -0,0 +1,211 @@
+import queue
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+from threading import Thread, Condition
+from qtpy.QtCore import QObject, Signal
+from pymodaq_plugins_transient_absorption.ta_processor import TAProcessor
+
+
+def worker_loop(commands, results):
+    """Entry point of the worker process: runs a TAProcessor on blocks
+    found in shared memory and sends back the processing results.
+    """
+    processor = TAProcessor()
+    events = []
+    processor.acquisition_done.connect(lambda: events.append('done'))
+    processor.acquisition_failed.connect(lambda: events.append('failed'))
+    memory = None
+    blocks = None
+    generation = 0
+
+    while True:
+        command, args = commands.get()
+        if command == 'stop':
+            break
+
+        if command == 'set_up':
+            processor.set_up(*args[0], **args[1])
+            generation = args[2]
+        elif command == 'buffers':
+            if memory is not None:
+                memory.close()
+            name, shape, dtype = args
+            memory = shared_memory.SharedMemory(name=name)
+            blocks = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+        elif command == 'mode':
+            processor.data_processing_mode, generation = args
+        elif command == 'reset':
+            processor.reset()
+            generation = args[0]
+        elif command == 'clear':
+            processor.clear_accumulation()
+        elif command == 'process':
+            slot, size = args
+            events.clear()
+            try:
+                dte, store = processor.process_data(blocks[slot, :size])
+                results.put(('result', slot, dte, store, list(events),
+                             processor.data_processing_mode, generation))
+            except Exception as e:
+                results.put(('error', slot, repr(e)))
+
+    processor.close()
+    blocks = None
+    if memory is not None:
+        memory.close()
+    results.put(('stopped',))
+
+
+class TAProcessorWorker(QObject):
+    """TAProcessor running in a worker process. Raw blocks are handed over
+    through shared memory slots, only the per block results come back and
+    are emitted as signals from a listener thread. process_data returns
+    immediately, the results arrive through data_ready. Every mode change
+    (set_up, reset, data_processing_mode) starts a new generation, the mode
+    reported with results of an older generation is ignored. If the worker
+    process dies, error is emitted and its slots are freed, close doesn't
+    wait for it.
+    """
+
+    acquisition_done = Signal()
+    acquisition_failed = Signal()
+    data_ready = Signal(object, bool) # DataToExport, store
+    error = Signal(str)
+
+    IDLE       = TAProcessor.IDLE
+    DARK       = TAProcessor.DARK
+    WHITELIGHT = TAProcessor.WHITELIGHT
+    TA         = TAProcessor.TA
+
+    def __init__(self, n_slots=4):
+        super().__init__()
+        self.n_slots = n_slots
+        self._memory = None
+        self._blocks = None
+        self._free = []
+        self._condition = Condition()
+        self._data_processing_mode = TAProcessor.IDLE
+        self._generation = 0
+        context = multiprocessing.get_context('spawn')
+        self._commands = context.Queue()
+        self._results = context.Queue()
+        self._process = context.Process(target=worker_loop,
+                                        args=(self._commands, self._results),
+                                        daemon=True)
+        self._process.start()
+        self._listener = Thread(target=self.listen, daemon=True)
+        self._listener.start()
+
+    def set_up(self, *args, **kwargs):
+        """Same arguments as TAProcessor.set_up"""
+        self.send_mode_command('set_up', (args, kwargs), TAProcessor.DARK)
+
+    @property
+    def data_processing_mode(self):
+        return self._data_processing_mode
+
+    @data_processing_mode.setter
+    def data_processing_mode(self, mode):
+        self.send_mode_command('mode', (mode,), mode)
+
+    def reset(self):
+        self.send_mode_command('reset', (), TAProcessor.DARK)
+
+    def send_mode_command(self, command, args, mode):
+        with self._condition:
+            self._generation += 1
+            self._data_processing_mode = mode
+            self._commands.put((command, args + (self._generation,)))
+
+    def clear_accumulation(self):
+        self._commands.put(('clear', ()))
+
+    def make_buffers(self, block_size, dtype):
+        self.release_buffers()
+        shape = (self.n_slots, block_size)
+        self._memory = shared_memory.SharedMemory(
+            create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        self._blocks = np.ndarray(shape, dtype=dtype, buffer=self._memory.buf)
+        self._free = list(range(self.n_slots))
+        self._commands.put(('buffers', (self._memory.name, shape,
+                                        np.dtype(dtype).str)))
+
+    def release_buffers(self):
+        if self._memory is None:
+            return
+        self.wait_idle(timeout=10)
+        self._blocks = None
+        self._memory.close()
+        self._memory.unlink()
+        self._memory = None
+
+    def process_data(self, raw_data, timeout=None):
+        """Copies raw_data into a free shared memory slot and queues it for
+        processing. Waits for a free slot at most timeout seconds, returns
+        False if the block could not be queued.
+        """
+        if self._blocks is None or len(raw_data) > self._blocks.shape[1] \
+           or raw_data.dtype != self._blocks.dtype:
+            self.make_buffers(len(raw_data), raw_data.dtype)
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._free, timeout):
+                return False
+            slot = self._free.pop()
+        self._blocks[slot, :len(raw_data)] = raw_data
+        self._commands.put(('process', (slot, len(raw_data))))
+        return True
+
+    def wait_idle(self, timeout=None):
+        """Waits until all queued blocks have been processed"""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: len(self._free) == self.n_slots, timeout)
+
+    def listen(self):
+        process = self._process
+        while True:
+            try:
+                message = self._results.get(timeout=0.1)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                # died, its results are all in the queue already
+                self.error.emit("worker process exited with code %s"
+                                % process.exitcode)
+                with self._condition:
+                    self._free = list(range(self.n_slots))
+                    self._condition.notify_all()
+                break
+            if message[0] == 'stopped':
+                break
+            if message[0] == 'error':
+                self.error.emit(message[2])
+            else:
+                _, _, dte, store, events, mode, generation = message
+                with self._condition:
+                    if generation == self._generation:
+                        self._data_processing_mode = mode
+                if dte is not None:
+                    self.data_ready.emit(dte, store)
+                if 'done' in events:
+                    self.acquisition_done.emit()
+                if 'failed' in events:
+                    self.acquisition_failed.emit()
+            with self._condition:
+                self._free.append(message[1])
+                self._condition.notify_all()
+
+    def close(self):
+        if self._process is None:
+            return
+        if self._process.is_alive():
+            self.wait_idle(timeout=10)
+            self._commands.put(('stop', ()))
+            self._process.join(timeout=10)
+        if self._process.is_alive(): # stuck
+            self._process.terminate()
+            self._process.join()
+        self._listener.join(timeout=10)
+        self._process = None
+        self.release_buffers()
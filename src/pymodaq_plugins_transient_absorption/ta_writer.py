@@ -0,0 +1,160 @@
+import time
+import queue
+import numpy as np
+import h5py
+from threading import Thread
+
+
+class TAWriter:
+    """Streams the results of an acquisition into an HDF5 file. Every call
+    appends one row to chunked, extendable datasets, the writing itself is
+    done by a background thread so that acquisition and display never wait
+    for the disk. The thread writes all rows queued meanwhile with one
+    assignment per dataset. Raw camera blocks are compressed with lzf.
+
+    Layout:
+        pixels                       x axis (pixels or wavelengths)
+        dark/signal, dark/reference  (acquisitions, n_pix)
+        whitelight/mean, .../rms     (acquisitions, n_pix)
+        ta/delay, ta/samples         (delays,)
+        ta/mean, ta/rms              (delays, n_pix)
+        raw/delay                    (blocks,)
+        raw/blocks                   (blocks, block size) uint16
+    """
+
+    rows_per_chunk = 16
+
+    def __init__(self, path, n_pix, x_axis=None, attributes=None,
+                 max_pending=64):
+        self.path = path
+        self.n_pix = n_pix
+        self.file = h5py.File(path, 'w')
+        self.file.attrs['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        for key, value in (attributes or {}).items():
+            self.file.attrs[key] = value
+        self.file['pixels'] = np.arange(n_pix) if x_axis is None \
+            else np.asarray(x_axis)
+        self.error = None
+        self._datasets = {}
+        self._rows = {}
+        self._queue = queue.Queue(max_pending)
+        self._thread = Thread(target=self.write_loop, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write_dark(self, signal, reference):
+        self.append('dark', signal=signal, reference=reference)
+
+    def write_whitelight(self, mean, rms=None):
+        if rms is None:
+            self.append('whitelight', mean=mean)
+        else:
+            self.append('whitelight', mean=mean, rms=rms)
+
+    def write_ta(self, delay, mean, rms=None, samples=0):
+        """Without rms a NaN row is written, so that the rows of all ta
+        datasets stay aligned.
+        """
+        if rms is None:
+            rms = np.full(np.shape(mean), np.nan)
+        self.append('ta', delay=np.float64(delay), mean=mean, rms=rms,
+                    samples=np.int64(samples))
+
+    def write_point(self, point):
+        """TA row of a DelayScan point, usable as the scan's callback"""
+        self.write_ta(point.delay, point.mean, point.rms, point.samples)
+
+    def write_raw(self, delay, block):
+        self.append('raw', delay=np.float64(delay), blocks=block)
+
+    def append(self, group, **rows):
+        """Queues one row for each named dataset of group. The data are
+        copied, the caller may reuse its buffers right away.
+        """
+        self.check_error()
+        self._queue.put((group, { name: np.array(row, copy=True)
+                                  for name, row in rows.items() }))
+
+    def flush(self):
+        """Waits until all queued rows are written and flushes the file"""
+        self._queue.join()
+        self.trim()
+        self.check_error()
+        self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self.trim()
+        self.file.close()
+        self.file = None
+        self.check_error()
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("TAWriter: writing %s failed" % self.path) \
+                from error
+
+    def write_loop(self):
+        running = True
+        while running:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                columns = {}
+                for item in items:
+                    if item is None:
+                        running = False
+                        continue
+                    group, rows = item
+                    for name, row in rows.items():
+                        columns.setdefault('%s/%s' % (group, name), []) \
+                            .append(row)
+                for name, rows in columns.items():
+                    self.append_rows(name, rows)
+            except Exception as e:
+                self.error = e
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def trim(self):
+        """Cuts the datasets, grown chunk by chunk, to the rows written"""
+        for name, n_rows in self._rows.items():
+            self._datasets[name].resize(n_rows, axis=0)
+
+    def append_rows(self, name, rows):
+        row = rows[0]
+        if name not in self._datasets:
+            if name == 'raw/blocks':
+                chunks = (1,) + row.shape
+                compression = 'lzf'
+            else:
+                chunks = (self.rows_per_chunk,) + row.shape
+                compression = None
+            self._datasets[name] = \
+                self.file.create_dataset(name, shape=(0,) + row.shape,
+                                         maxshape=(None,) + row.shape,
+                                         dtype=row.dtype, chunks=chunks,
+                                         compression=compression)
+            self._rows[name] = 0
+        dataset = self._datasets[name]
+        n_rows = self._rows[name]
+        end = n_rows + len(rows)
+        if end > len(dataset):
+            chunk = dataset.chunks[0]
+            dataset.resize(-(-end // chunk) * chunk, axis=0)
+        dataset[n_rows:end] = np.stack(rows)
+        self._rows[name] = end
@@ -1,5 +1,8 @@
 import numpy as np
-from pymodaq_plugins_transient_absorption.averager import Averager
+from pymodaq_plugins_transient_absorption.averager import Averager, \
+    WelfordAverager, IntegerAverager, AveragerFactory
+from pymodaq_plugins_transient_absorption.ta_processor import \
+    StatisticsCondition
 
 
 def make_data(n_data, n_pix, offset=0):
@@ -118,6 +121,105 @@ def test_multiple(fail=False):
 def test_fail():
     test_multiple(fail=True)
 
+
+def test_batched():
+    n_pix = 10
+    n_scans = 25
+    rng = np.random.default_rng(1)
+    data = rng.integers(0, 2**16, n_pix * 2 * n_scans).astype(np.uint16)
+    for offset in [0, n_pix]:
+        averagers = [Averager(start=2, end=9, stride=2 * n_pix, offset=offset,
+                              min_samples=20, limit_diff_rms=0.5,
+                              limit_diff_mean=0.5, max_attempts=3)
+                     for _ in range(2)]
+        averagers[1].batched = False
+        for _ in range(4):
+            results = [av.take_data(data) for av in averagers]
+            assert results[0] == results[1]
+            assert averagers[0].samples == averagers[1].samples
+            assert averagers[0].attempts == averagers[1].attempts
+            assert max(abs(averagers[0].sum_values
+                           - averagers[1].sum_values)) < 1e-6
+            assert max(abs(averagers[0].sum_squared_values
+                           - averagers[1].sum_squared_values)) < 1e-3
+
+
+def test_welford():
+    n_pix = 10
+    n_scans = 250
+    rng = np.random.default_rng(2)
+    condition = StatisticsCondition(0, n_pix)
+    averager = AveragerFactory.make(condition, 2 * n_pix, engine='welford')
+    scan_averager = AveragerFactory.make(condition, 2 * n_pix, engine='welford')
+    scan_averager.batched = False
+    assert type(averager) == WelfordAverager
+    blocks = [rng.normal(1e9, 1, n_pix * 2 * n_scans) for _ in range(8)]
+    for block in blocks:
+        averager.take_data(block)
+        scan_averager.take_data(block)
+    selected = np.concatenate([block.reshape(n_scans, 2, n_pix)[:, 0]
+                               for block in blocks])
+    assert averager.samples == len(selected)
+    for av in [averager, scan_averager]:
+        assert max(abs(av.mean - selected.mean(axis=0))) < 1e-5
+        assert max(abs(av.rms - selected.std(axis=0, ddof=1))) < 1e-6
+
+
+def test_sliding():
+    n_pix = 20
+    min_samples = 50
+    rng = np.random.default_rng(5)
+    data = rng.normal(100, 1, 400 * min_samples * n_pix)
+    block = min_samples * n_pix
+    results = {}
+    for convergence in [Averager.BLOCKS, Averager.SLIDING]:
+        averager = AveragerFactory.make(
+            StatisticsCondition(0, n_pix, 0.05, 0.05, min_samples, 100),
+            n_pix, convergence=convergence)
+        assert averager.convergence == convergence
+        for n_blocks,pos in enumerate(range(0, len(data), block), 1):
+            result = averager.take_data(data[pos:pos + block])
+            if result != Averager.CONTINUE:
+                break
+            if convergence == Averager.SLIDING:
+                # failed checks keep the accumulated samples
+                assert averager.samples == n_blocks * min_samples
+                assert averager.samples_to_check() == min_samples
+            else:
+                assert averager.samples == 0
+        results[convergence] = result, averager.samples, averager.attempts
+    # consecutive blocks of 50 scans never agree within 5%
+    assert results[Averager.BLOCKS] == (Averager.FAIL, min_samples, 100)
+    result, samples, attempts = results[Averager.SLIDING]
+    assert result == Averager.SUCCESS
+    assert samples == (attempts + 1) * min_samples
+
+
+def test_integer():
+    n_pix = 10
+    rng = np.random.default_rng(6)
+    data = rng.integers(0, 65536, 2 * n_pix * 300, dtype=np.uint16)
+    condition = StatisticsCondition(2, 8)
+    for batched in [True, False]:
+        averager = AveragerFactory.make(condition, 2 * n_pix, n_pix,
+                                        engine='integer')
+        assert type(averager) == IntegerAverager
+        averager.batched = batched
+        averager.take_data(data[:2 * n_pix * 100])
+        averager.take_data(data[2 * n_pix * 100:])
+        assert averager.sum_values.dtype == np.int64
+        selected = data.reshape(300, 2, n_pix)[:, 1, 2:8].astype(np.int64)
+        assert np.all(averager.sum_values == selected.sum(axis=0))
+        assert np.all(averager.sum_squared_values
+                      == (selected**2).sum(axis=0))
+        assert max(abs(averager.mean - selected.mean(axis=0))) < 1e-9
+        assert max(abs(averager.rms - selected.std(axis=0, ddof=1))) < 1e-8
+    try:
+        averager.take_data(data.astype(np.float64))
+        assert False
+    except ValueError:
+        pass
+
     
 if __name__ == '__main__':
     test_set_up()
@@ -125,3 +227,7 @@ if __name__ == '__main__':
     test_ok()
     test_multiple()
     test_fail()
+    test_batched()
+    test_welford()
+    test_sliding()
+    test_integer()
@@ -0,0 +1,69 @@
+import numpy as np
+from pymodaq_plugins_transient_absorption.hardware.controller import \
+    MockTACamera, MockTAController
+
+
+def test_block_shape():
+    camera = MockTACamera(n_pixels=20, scans_per_block=10, seed=1)
+    data = camera.calculate_block(0, 0, True, True, False)
+    assert data.dtype == np.uint16
+    assert len(data) == 20 * 2 * 10
+    out = np.zeros(20 * 2 * 10, dtype=np.uint16)
+    assert camera.calculate_block(0, 0, True, True, True, out=out) is out
+    assert np.all(out > 0)
+
+
+def test_seed():
+    blocks = [MockTACamera(n_pixels=20, scans_per_block=10, seed=4)
+              .calculate_block(0, 0, True, True, True) for _ in range(2)]
+    assert np.all(blocks[0] == blocks[1])
+    other = MockTACamera(n_pixels=20, scans_per_block=10, seed=5) \
+        .calculate_block(0, 0, True, True, True)
+    assert np.any(blocks[0] != other)
+
+
+def test_block_pattern():
+    camera = MockTACamera(n_pixels=40, scans_per_block=400, seed=2)
+    n_pix = camera.n_pixels
+    scans = camera.calculate_block(0, 0, True, True, True) \
+        .reshape(400, 2, n_pix).astype(np.float64)
+    pumped, unpumped, scatter, dark = [scans[i::4] for i in range(4)]
+    assert abs(dark[:, 0].mean() - camera.dark_signal) < 1
+    assert abs(dark[:, 1].mean() - camera.dark_reference) < 1
+    assert abs(dark[:, 0].std() - camera.rms_dark_signal) < 1
+    assert np.all(abs((scatter - dark).mean(axis=0)[1]) < 5)
+    peak = np.argmax(camera.scatter)
+    assert abs((scatter - dark)[:, 0, peak].mean()
+               - camera.excitation_scatter) < 50
+    whitelight = (unpumped[:, 1] - dark[:, 1]).mean(axis=0)
+    assert np.max(abs(whitelight - camera.whitelight * camera.reference)) \
+        < 0.02 * camera.reference
+    signal_pumped = (pumped - scatter)[:, 0].mean(axis=0)
+    reference_pumped = (pumped - dark)[:, 1].mean(axis=0)
+    signal_unpumped = (unpumped - dark)[:, 0].mean(axis=0)
+    reference_unpumped = (unpumped - dark)[:, 1].mean(axis=0)
+    ta = -np.log10(signal_pumped * reference_unpumped
+                   / (signal_unpumped * reference_pumped))
+    absorption = camera.calculate_absorption(0, 0)
+    center = slice(n_pix // 4, 3 * n_pix // 4)
+    assert np.max(abs(ta - absorption)[center]) < 0.01
+
+
+def test_record_replay(tmp_path):
+    path = tmp_path / 'blocks.npy'
+    controller = MockTAController(seed=3)
+    controller.camera.scans_per_block = 10
+    controller.record_blocks(path, 3)
+    recorded = np.load(path)
+    assert recorded.shape == (3, 2 * controller.camera.n_pixels * 10)
+
+    replay = MockTAController()
+    replay.load_recording(path)
+    for i in range(5):
+        assert np.all(replay.grab_spectrum() == recorded[i % 3])
+    replay.unload_recording()
+    assert len(replay.grab_spectrum()) == 2 * replay.camera.n_pixels * 250
+
+    controller = MockTAController(seed=3)
+    controller.camera.scans_per_block = 10
+    assert np.all(controller.grab_spectrum() == recorded[0])
@@ -0,0 +1,169 @@
+import time
+import numpy as np
+from pymodaq_plugins_transient_absorption.delay_scan import DelaySchedule, \
+    DelayScan, actuator_move
+from pymodaq_plugins_transient_absorption.averager import Averager
+from pymodaq_plugins_transient_absorption.ta_matrix import TAMatrix, \
+    ScanAccumulator
+from pymodaq_plugins_transient_absorption.hardware.controller import \
+    MockTAController
+from pymodaq_plugins_transient_absorption.ta_processor import TAProcessor, \
+    TACondition
+
+
+def prepare():
+    """Controller and processor with dark and whitelight references"""
+    controller = MockTAController(seed=12)
+    controller.camera.n_pixels = 40
+    controller.camera.scans_per_block = 100
+    controller.camera.calculate_base_data()
+    processor = TAProcessor()
+    processor.set_up(40, TACondition(3, 3, 100, 10, 3, 3, 100, 10, 3),
+                     [[5, 10], [20, 25], [30, 35]], False)
+    for pump, probe in [(0, 0), (0, 1)]:
+        controller.set_shutter_value(pump, 'Excitation')
+        controller.set_shutter_value(probe, 'Probe')
+        while processor.data_processing_mode != TAProcessor.IDLE:
+            processor.process_data(controller.grab_spectrum())
+        processor.data_processing_mode = TAProcessor.WHITELIGHT
+    controller.set_shutter_value(1, 'Excitation')
+    return controller, processor
+
+
+def test_schedule():
+    linear = DelaySchedule(DelaySchedule.LINEAR, -1, 2, 0.1).delays()
+    assert len(linear) == 31
+    assert np.isclose(linear[-1], 2)
+    log = DelaySchedule(DelaySchedule.LOG, 1, 1000, n_log=4).delays()
+    assert np.allclose(log, [1, 10, 100, 1000])
+    lin_log = DelaySchedule(DelaySchedule.LIN_LOG, -1, 100, 0.5, 1,
+                            2).delays()
+    assert np.allclose(lin_log, [-1, -0.5, 0, 0.5, 1, 10, 100])
+    for schedule in [DelaySchedule(DelaySchedule.LOG, 0, 1),
+                     DelaySchedule(DelaySchedule.LIN_LOG, 0, 1, 0.1, 2),
+                     DelaySchedule('cubic')]:
+        try:
+            schedule.delays()
+            assert False
+        except ValueError:
+            pass
+
+
+def test_scan():
+    controller, processor = prepare()
+    dark = processor.dark_signal
+    delays = [-5e-12, 0, 5e-12, 2e-11]
+    points = []
+    matrix = TAMatrix(delays, 40)
+    scan = DelayScan(controller, processor, delays, max_blocks=8,
+                     matrix=matrix)
+    assert scan.run(points.append) == points
+    assert matrix.scans == 1
+    assert np.all(matrix.mean == [point.mean for point in points])
+    assert processor.dark_signal is dark # no new dark per point
+    assert [point.delay for point in points] == delays
+    center = slice(14, 30) # away from the excitation scatter
+    for point in points:
+        # the TA has no convergence criterion, max_blocks ends the point
+        assert point.blocks == 8
+        assert point.result == Averager.CONTINUE
+        absorption = controller.camera.calculate_absorption(point.delay, 0)
+        assert np.max(abs(point.mean - absorption)[center]) < 0.02
+    assert controller.get_delay_value() == delays[-1]
+
+
+def test_repeated():
+    controller, processor = prepare()
+    delays = [0, 5e-12]
+    accumulator = ScanAccumulator(delays, 40, min_scans=2)
+    scan = DelayScan(controller, processor, delays, max_blocks=2,
+                     matrix=accumulator)
+    assert scan.run_scans(3) is accumulator
+    assert len(accumulator.records) == 3
+    assert accumulator.accepted + len(accumulator.rejected) == 3
+    assert np.all(accumulator.counts[:, 14:30] >= 2 * 2 * 10)
+
+
+def test_overlap():
+    """Stage moves run while the previous point is processed"""
+    controller, processor = prepare()
+    moves = []
+    def move(delay):
+        moves.append(time.perf_counter())
+        time.sleep(0.1)
+        controller.set_delay_value(delay)
+    finished = []
+    def callback(point):
+        time.sleep(0.1)
+        finished.append(time.perf_counter())
+
+    points = DelayScan(controller, processor, [0, 1e-12, 2e-12, 3e-12],
+                       move=move, max_blocks=2).run(callback)
+    assert [point.result for point in points] == [Averager.CONTINUE] * 4
+    assert [point.blocks for point in points] == [2] * 4
+    assert moves[1] < finished[0]
+
+
+def test_adaptive():
+    """Quiet delays converge early, the noisy one gets the saved blocks"""
+    controller, processor = prepare()
+    noisy = 2e-12
+    def move(delay):
+        controller.camera.relative_rms_signal = \
+            0.15 if delay == noisy else 0.05
+        controller.set_delay_value(delay)
+    processor.max_ta = 8
+    processor.max_ta_rms = 2.2e-4
+    scan = DelayScan(controller, processor, [0, 1e-12, noisy, 3e-12],
+                     move=move, pool_size=2, adaptive=True)
+    points = scan.run()
+    report = scan.report()
+    assert list(report['samples']) == [point.samples for point in points]
+    assert scan.blocks <= scan.budget == 32
+    assert processor.max_ta == 8 # restored
+    for point in points:
+        if point.delay == noisy:
+            assert point.blocks > 8 # first pass and refinement
+        else:
+            assert point.converged
+            assert point.blocks < 8
+            assert point.error <= 2.2e-4
+    try:
+        processor.max_ta = 0
+        DelayScan(controller, processor, [0], adaptive=True)
+        assert False
+    except ValueError:
+        pass
+    processor.set_up(40, TACondition(3, 3, 100, 10, 3, 3, 100, 10, 3), [],
+                     False)
+    processor.clear_accumulation() # no references yet
+    try:
+        DelayScan(controller, processor, [0])
+        assert False
+    except ValueError:
+        pass
+
+
+def test_actuator():
+    from pymodaq_gui.qt_utils import mkQApp
+    from pymodaq_plugins_transient_absorption.daq_move_plugins.\
+        daq_move_MockDelayLine import DAQ_Move_MockDelayLine
+    app = mkQApp('test')
+    controller, processor = prepare()
+    plugin = DAQ_Move_MockDelayLine(None, None)
+    plugin.ini_stage()
+    plugin.controller = controller
+    points = DelayScan(controller, processor, [0, 1e-12],
+                       move=actuator_move(plugin), max_blocks=2).run()
+    assert len(points) == 2
+    assert controller.get_delay_value() == 1e-12
+    plugin.close()
+
+
+if __name__ == '__main__':
+    test_schedule()
+    test_scan()
+    test_repeated()
+    test_overlap()
+    test_adaptive()
+    test_actuator()
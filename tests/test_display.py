@@ -0,0 +1,61 @@
+import time
+from pymodaq_gui.qt_utils import mkQApp
+from pymodaq_plugins_transient_absorption.display import DisplayCoalescer
+
+
+class Viewer:
+
+    def __init__(self, delay=0):
+        self.shown = []
+        self.delay = delay
+
+    def show_data(self, data):
+        time.sleep(self.delay)
+        self.shown.append(data)
+
+
+def test_coalesce():
+    app = mkQApp('test')
+    display = DisplayCoalescer()
+    display.stop() # render by hand
+    reports = []
+    display.rendered.connect(lambda *report: reports.append(report))
+    upper, lower = Viewer(0.01), Viewer()
+    for i in range(5):
+        display.show(upper, i)
+        display.show(lower, -i)
+    display.show(lower, None) # ignored
+    display.render()
+    assert upper.shown == [4] and lower.shown == [-4] # latest only
+    assert display.dropped == 8
+    assert display.frames == 1
+    assert display.render_time >= 0.01
+    assert reports == [(display.render_time, 8)]
+    display.render() # nothing pending
+    assert display.frames == 1
+
+    display.show(upper, 5)
+    display.clear()
+    display.render()
+    assert upper.shown == [4]
+
+
+def test_timer():
+    app = mkQApp('test')
+    display = DisplayCoalescer(frame_rate=50)
+    viewer = Viewer()
+    start = time.perf_counter()
+    i = 0
+    while time.perf_counter() - start < 0.3:
+        display.show(viewer, i) # never waits for plotting
+        i += 1
+        app.processEvents()
+    display.stop()
+    assert 0 < display.frames <= 0.3 * 50 + 1
+    assert display.frames + display.dropped <= i
+    assert viewer.shown == sorted(viewer.shown)
+
+
+if __name__ == '__main__':
+    test_coalesce()
+    test_timer()
@@ -0,0 +1,84 @@
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from pymodaq_plugins_transient_absorption.instrumentation import \
+    Instrumentation, Stage
+
+
+def test_disabled():
+    instrumentation = Instrumentation(enabled=False)
+    def function(x):
+        return x
+    assert instrumentation.timed('stage')(function) is function # no cost
+    instrumentation.count('event')
+    assert instrumentation.summary() == {}
+
+
+def test_timed():
+    instrumentation = Instrumentation(enabled=True)
+    @instrumentation.timed('sleep')
+    def sleep(duration):
+        time.sleep(duration)
+        return duration
+    assert sleep.__name__ == 'sleep'
+    for _ in range(5):
+        assert sleep(0.002) == 0.002
+    instrumentation.count('event', 1000)
+    summary = instrumentation.summary()
+    count, mean, median, p99 = summary['sleep']
+    assert count == 5
+    assert 2000 <= median <= p99 < 50000 # us
+    assert 2000 <= mean < 50000
+    assert summary['event'] == (1, 1, 1, 1)
+
+    counts, edges = instrumentation.stage('sleep').histogram(bins=4)
+    assert counts.sum() == 5 and len(edges) == 5
+    dte = instrumentation.to_dte()
+    assert dte.name == 'instrumentation'
+    data = dte.get_data_from_name('sleep')
+    assert data.labels == ['mean us', 'median us', 'p99 us', 'count']
+    assert data[3][0] == 5
+    histogram = dte.get_data_from_name('sleep histogram')
+    assert histogram.dim.name == 'Data1D'
+    assert histogram.size == 20 and histogram[0].sum() == 5
+    assert histogram.axes[0].units == 'us'
+
+
+def test_rolling():
+    stage = Stage('rolling')
+    for i in range(Stage.history_size + 10):
+        stage.record(i)
+    assert stage.count == Stage.history_size + 10
+    recent = stage.recent()
+    assert len(recent) == Stage.history_size
+    assert recent.min() == 10 # the oldest are overwritten
+    assert stage.total_ns == np.arange(stage.count).sum()
+
+
+def test_switch():
+    code = "from pymodaq_plugins_transient_absorption.ta_processor import " \
+        "TAProcessor; print(hasattr(TAProcessor.process_ta, '__wrapped__'))"
+    for value, wrapped in [('1', 'True'), ('0', 'False')]:
+        env = dict(os.environ, TA_INSTRUMENTATION=value)
+        output = subprocess.run([sys.executable, '-c', code], env=env,
+                                capture_output=True, text=True, check=True)
+        assert output.stdout.strip() == wrapped
+
+
+def test_lazy_import():
+    code = "import sys; from pymodaq_plugins_transient_absorption.hardware." \
+        "controller import MockTAController; " \
+        "print('pymodaq.utils.data' in sys.modules)"
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                            text=True, check=True)
+    assert output.stdout.strip() == 'False'
+
+
+if __name__ == '__main__':
+    test_disabled()
+    test_timed()
+    test_rolling()
+    test_switch()
+    test_lazy_import()
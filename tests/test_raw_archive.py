@@ -0,0 +1,102 @@
+import pickle
+import numpy as np
+from pymodaq_plugins_transient_absorption.hardware.raw_archive import \
+    RawArchive, RawArchiveWriter, is_archive
+from pymodaq_plugins_transient_absorption.hardware.controller import \
+    MockTAController
+from pymodaq_plugins_transient_absorption.ta_processor import TAProcessor, \
+    TACondition
+
+
+def make_controller():
+    controller = MockTAController(seed=9)
+    controller.camera.n_pixels = 20
+    controller.camera.scans_per_block = 20
+    controller.camera.calculate_base_data()
+    return controller
+
+
+def test_write_read(tmp_path):
+    path = tmp_path / 'run.raw'
+    rng = np.random.default_rng(9)
+    blocks = [rng.integers(0, 65536, size, dtype=np.uint16)
+              for size in [40, 80, 40]]
+    with RawArchiveWriter(path) as writer:
+        for i,block in enumerate(blocks):
+            writer.append(block, 10, delay=i % 2, polarizer=45, pump=i > 0,
+                          timestamp=100 + i)
+    with RawArchiveWriter(tmp_path / 'run') as writer: # appends
+        writer.append(blocks[0], 10, delay=2)
+        # the data are on disk once the index entry is
+        assert (tmp_path / 'run.raw').stat().st_size == 400
+    assert is_archive(path)
+    assert not is_archive(tmp_path / 'other.raw')
+
+    archive = RawArchive(path)
+    assert len(archive) == 4
+    for i,block in enumerate(blocks + blocks[:1]):
+        assert np.all(archive[i] == block)
+        assert isinstance(archive[i].base, np.memmap) # no copy
+    assert list(archive.index['offset']) == [0, 80, 240, 320]
+    assert list(archive.index['timestamp'][:3]) == [100, 101, 102]
+    assert np.all(archive.index['polarizer'][:3] == 45)
+    assert list(archive.select(delay=0, pump=True)) == [2]
+    groups = archive.groups()
+    assert list(groups) == [0, 1, 2]
+    assert list(groups[0]) == [0, 2]
+
+    copy = pickle.loads(pickle.dumps(archive))
+    assert np.all(copy[3] == blocks[0])
+
+
+def test_controller_archive(tmp_path):
+    path = tmp_path / 'scan.raw'
+    controller = make_controller()
+    controller.start_archiving(path)
+    grabbed = []
+    for delay in [0, 1e-12]:
+        controller.delay_line.move_at(delay)
+        for _ in range(2):
+            grabbed.append(controller.grab_spectrum().copy())
+    controller.stop_archiving()
+    controller.grab_spectrum() # not archived any more
+
+    archive = RawArchive(path)
+    assert len(archive) == 4
+    assert list(archive.index['delay']) == [0, 0, 1e-12, 1e-12]
+    assert np.all(archive.index['n_pixels'] == 20)
+    for block,expected in zip(archive.blocks(), grabbed):
+        assert np.all(block == expected)
+
+    replay = MockTAController()
+    replay.load_recording(path)
+    for i in range(5):
+        assert np.all(replay.grab_spectrum() == grabbed[i % 4])
+
+
+def test_process_archive(tmp_path):
+    path = tmp_path / 'dark.raw'
+    controller = make_controller()
+    controller.shutters['Probe'].move_at(0)
+    controller.record_blocks(path, 10)
+    archive = RawArchive(path)
+    assert len(archive) == 10
+
+    ta_processor = TAProcessor()
+    ta_processor.set_up(20, TACondition(1, 1, 20, 30, 1, 1, 20, 10, 3), [],
+                        False)
+    processed = list(ta_processor.process_archive(archive))
+    assert ta_processor.data_processing_mode == TAProcessor.IDLE
+    i, dte, store = processed[-1]
+    assert store
+    assert i == len(processed) - 1 < len(archive)
+    assert abs(ta_processor.dark_signal.mean()
+               - controller.camera.dark_signal) < 1
+
+
+if __name__ == '__main__':
+    import tempfile, pathlib
+    with tempfile.TemporaryDirectory() as directory:
+        test_write_read(pathlib.Path(directory))
+        test_controller_archive(pathlib.Path(directory))
+        test_process_archive(pathlib.Path(directory))
@@ -0,0 +1,71 @@
+import h5py
+import numpy as np
+from pymodaq_plugins_transient_absorption.hardware.controller import \
+    MockTAController
+from pymodaq_plugins_transient_absorption.reprocess import reprocess, main
+from pymodaq_plugins_transient_absorption.ta_processor import TACondition
+
+
+delays = [0, 5e-12, 2e-11]
+
+
+def make_archive(path):
+    controller = MockTAController(seed=11)
+    controller.camera.n_pixels = 40
+    controller.camera.scans_per_block = 100
+    controller.camera.calculate_base_data()
+    for pump, probe in [(0, 0), (0, 1)]:
+        controller.shutters['Excitation'].move_at(pump)
+        controller.shutters['Probe'].move_at(probe)
+        controller.record_blocks(path, 6)
+    controller.shutters['Excitation'].move_at(1)
+    for delay in delays:
+        controller.delay_line.move_at(delay)
+        controller.record_blocks(path, 4)
+    return controller.camera
+
+
+def test_reprocess(tmp_path):
+    path = tmp_path / 'scan.raw'
+    camera = make_archive(path)
+    condition = TACondition(3, 3, 100, 10, 3, 3, 100, 10, 3)
+    ranges = [[5, 10], [20, 25], [30, 35]]
+    reprocess(path, tmp_path / 'serial.h5', condition, ranges, workers=0)
+    reprocess(path, tmp_path / 'parallel.h5', condition, ranges, workers=2)
+    with h5py.File(tmp_path / 'serial.h5', 'r') as serial, \
+         h5py.File(tmp_path / 'parallel.h5', 'r') as parallel:
+        assert list(serial['ta/delay'][:]) == delays
+        assert serial['ta/mean'].shape == (len(delays), 40)
+        assert np.all(serial['ta/mean'][:] == parallel['ta/mean'][:])
+        assert np.all(serial['ta/samples'][:] == parallel['ta/samples'][:])
+        assert np.all(serial['ta/checked'][:] == 4 * 50)
+        center = slice(14, 30) # away from the excitation scatter
+        for i,delay in enumerate(delays):
+            absorption = camera.calculate_absorption(delay, 0)
+            assert np.max(abs(serial['ta/mean'][i] - absorption)[center]) \
+                < 0.01
+
+
+def test_sweep(tmp_path):
+    path = tmp_path / 'scan.raw'
+    make_archive(path)
+    output = tmp_path / 'sweep.h5'
+    main([str(path), str(output), '--statistics', '5-10,20-25,30-35',
+          '--limit-diff-ta', '0.5', '3', '--min-samples', '100',
+          '--min-dark', '100', '--workers', '0'])
+    with h5py.File(output, 'r') as file:
+        assert sorted(file.keys()) == ['pixels', 'ta_0', 'ta_1']
+        strict, loose = file['ta_0'], file['ta_1']
+        assert strict.attrs['limit_diff_ta'] == 0.5
+        assert loose.attrs['min_samples'] == 100
+        # a stricter acceptance rejects more whitelights
+        assert np.all(strict['samples'][:] <= loose['samples'][:])
+        assert np.sum(strict['samples'][:]) < np.sum(loose['samples'][:])
+
+
+if __name__ == '__main__':
+    import tempfile, pathlib
+    with tempfile.TemporaryDirectory() as directory:
+        test_reprocess(pathlib.Path(directory))
+    with tempfile.TemporaryDirectory() as directory:
+        test_sweep(pathlib.Path(directory))
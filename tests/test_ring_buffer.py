@@ -0,0 +1,113 @@
+import time
+import numpy as np
+from pymodaq_plugins_transient_absorption.hardware.ring_buffer import \
+    BlockRing, BlockPool
+from pymodaq_plugins_transient_absorption.hardware.controller import \
+    MockTAController
+
+
+def fill(ring, value):
+    slot = ring.reserve()
+    if slot is not None:
+        ring.blocks[slot] = value
+        ring.commit(slot)
+    return slot
+
+
+def test_fifo():
+    ring = BlockRing(3, 4)
+    for value in range(3):
+        fill(ring, value)
+    assert ring.statistics.depth == 3
+    for value in range(3):
+        slot = ring.take()
+        assert np.all(ring.blocks[slot] == value)
+        ring.release(slot)
+    assert ring.statistics.produced == 3
+    assert ring.statistics.consumed == 3
+    assert ring.statistics.depth == 0
+    assert ring.statistics.max_depth == 3
+    assert ring.take(timeout=0.01) is None
+
+
+def test_drop_newest():
+    ring = BlockRing(2, 4, BlockRing.DROP_NEWEST)
+    for value in range(4):
+        fill(ring, value)
+    assert ring.statistics.dropped == 2
+    values = []
+    while (slot := ring.take(timeout=0)) is not None:
+        values.append(ring.blocks[slot][0])
+        ring.release(slot)
+    assert values == [0, 1]
+
+
+def test_drop_oldest():
+    ring = BlockRing(2, 4, BlockRing.DROP_OLDEST)
+    busy = fill(ring, 0)
+    assert ring.take() == busy # consumer works on block 0
+    for value in range(1, 4):
+        fill(ring, value)
+    assert ring.statistics.dropped == 2
+    assert ring.statistics.depth == 1
+    ring.release(busy)
+    slot = ring.take()
+    assert np.all(ring.blocks[slot] == 3)
+
+
+def test_block_and_close():
+    ring = BlockRing(1, 4)
+    fill(ring, 0)
+    ring.close()
+    assert ring.reserve() is None
+    assert ring.take() is None
+
+
+def test_pool():
+    pool = BlockPool(2, 4)
+    blocks = [pool.acquire() for _ in range(2)]
+    assert pool.available == 0
+    assert pool.acquire(timeout=0.01) is None
+    pool.release(blocks[1])
+    assert pool.acquire() is not None
+    try:
+        pool.release(np.zeros(4, dtype=np.uint16))
+        assert False
+    except ValueError:
+        pass
+
+
+def test_controller_pool():
+    controller = MockTAController(seed=1)
+    controller.camera.scans_per_block = 4
+    addresses = set()
+
+    def consumer(data):
+        addresses.add(data.ctypes.data)
+
+    controller.start_continuous_grabbing(consumer)
+    time.sleep(0.05)
+    controller.stop_continuous_grabbing()
+    assert len(addresses) <= controller.pool_size
+    assert controller.pool.available == controller.pool_size
+
+
+def test_controller_pipeline():
+    controller = MockTAController(seed=1)
+    controller.camera.scans_per_block = 4
+    received = []
+
+    def slow_consumer(data):
+        received.append(data[0])
+        time.sleep(0.01)
+
+    controller.start_continuous_grabbing(slow_consumer, ring_size=2,
+                                         policy=BlockRing.DROP_NEWEST)
+    time.sleep(0.2)
+    controller.stop_continuous_grabbing()
+    statistics = controller.ring_statistics()
+    assert len(received) == statistics.consumed
+    assert statistics.dropped > 0
+    assert statistics.produced >= statistics.consumed
+    assert statistics.max_depth <= 2
+    assert statistics.mean_latency > 0.005
@@ -0,0 +1,86 @@
+import numpy as np
+from pymodaq_gui.qt_utils import mkQApp
+from pymodaq_plugins_transient_absorption.ta_map_viewer import TAMapViewer, \
+    decimate_minmax, minmax_factor
+from pymodaq_plugins_transient_absorption.ta_matrix import TAMatrix
+from pymodaq_plugins_transient_absorption.delay_scan import DelayScan
+from test_delay_scan import prepare
+
+
+def test_decimate():
+    data = np.zeros((3, 1000))
+    data[1, 517] = 5
+    data[2, 10] = -5
+    data[0, :100] = np.nan
+    factor = minmax_factor(1000, 100)
+    assert factor == 20
+    reduced = decimate_minmax(data, factor, axis=1)
+    assert reduced.shape == (3, 100)
+    assert reduced[1].max() == 5 and reduced[2].min() == -5 # peaks kept
+    assert np.all(np.isnan(reduced[0, :10]))
+    assert not np.any(np.isnan(reduced[0, 10:]))
+    assert decimate_minmax(data, 1) is data
+    assert minmax_factor(50, 100) == 1
+    assert decimate_minmax(np.arange(7.), 3).tolist() == [0, 2, 3, 5, 6, 6]
+
+
+def test_viewer():
+    app = mkQApp('test')
+    delays = np.geomspace(1, 1000, 400)
+    matrix = TAMatrix(delays, 1000)
+    viewer = TAMapViewer()
+    viewer.timer.stop() # render by hand
+    viewer.set_display_size(200, 100)
+    viewer.set_matrix(matrix)
+    viewer.set_pixels([100, 500])
+    viewer.render()
+    assert viewer.frames == 1
+    assert viewer._display.shape == (100, 200)
+    assert np.all(np.isnan(viewer._display))
+
+    for row in [3, 250]:
+        matrix.update(row, np.full(1000, row / 1000), np.ones(1000), 10)
+        viewer.update_rows([row])
+    matrix.mean[100] = 1 # not reported, not rendered
+    viewer.render()
+    assert viewer.frames == 2
+    display = viewer._display
+    assert np.all(display[0:2] == 0.003) # min and max of rows 0-7
+    assert np.all(display[62:64] == 0.25)
+    assert np.count_nonzero(np.isfinite(display)) == 4 * 200
+    assert viewer.image.levels[1] == 0.25
+    kinetics = viewer.kinetics[0]
+    assert kinetics[250] == 0.25 and np.isnan(kinetics[100])
+
+    viewer.render() # nothing changed
+    assert viewer.frames == 2
+    viewer.set_display_size(2000, 1000) # no decimation needed
+    viewer.render()
+    assert viewer._display.shape == (400, 1000)
+    assert np.all(viewer._display[100] == 1)
+
+
+def test_scan():
+    app = mkQApp('test')
+    controller, processor = prepare()
+    delays = [-5e-12, 0, 5e-12, 2e-11]
+    matrix = TAMatrix(delays, 40)
+    viewer = TAMapViewer()
+    viewer.timer.stop()
+    viewer.set_display_size(100, 100)
+    viewer.set_matrix(matrix)
+    viewer.set_pixels([20])
+    scan = DelayScan(controller, processor, delays, max_blocks=2,
+                     matrix=matrix)
+    scan.run(viewer.update_point)
+    viewer.render()
+    assert viewer.frames == 1
+    assert np.all(np.isfinite(viewer._display))
+    assert np.array_equal(viewer._display, matrix.mean)
+    assert np.array_equal(viewer.kinetics[0], matrix.mean[:, 20])
+
+
+if __name__ == '__main__':
+    test_decimate()
+    test_viewer()
+    test_scan()
@@ -0,0 +1,146 @@
+import h5py
+import numpy as np
+from pymodaq_plugins_transient_absorption.ta_matrix import TAMatrix, \
+    ScanAccumulator
+
+
+def statistics(data):
+    return data.mean(axis=0), data.std(axis=0, ddof=1), len(data)
+
+
+def test_update():
+    rng = np.random.default_rng(21)
+    delays = [-1, 0, 1, 2]
+    n_pix = 6
+    matrix = TAMatrix(delays, n_pix)
+    assert matrix.shape == (4, 6)
+    assert np.all(np.isnan(matrix.mean))
+
+    scans = [[rng.normal(i, 1, (n, n_pix)) for i in range(len(delays))]
+             for n in [10, 30]]
+    matrix.update(1, *statistics(scans[0][1]))
+    assert np.all(np.isnan(matrix.mean[[0, 2, 3]]))
+    assert np.allclose(matrix.mean[1], scans[0][1].mean(axis=0))
+    # a refined point replaces the contribution of the scan
+    matrix.update(1, *statistics(scans[0][1][:5]))
+    assert np.all(matrix.counts[1] == 5)
+    for i in range(len(delays)):
+        matrix.update(i, *statistics(scans[0][i]))
+    matrix.end_scan()
+    mean, rms, samples = statistics(scans[1][2])
+    mean[0] = rms[0] = np.nan # no TA for pixel 0
+    for i in range(len(delays)):
+        if i == 2:
+            matrix.update(2, mean, rms, samples)
+        else:
+            matrix.update(i, *statistics(scans[1][i]))
+    matrix.end_scan()
+    assert matrix.scans == 2
+
+    for i in range(len(delays)):
+        merged = np.concatenate((scans[0][i], scans[1][i]))
+        mean, rms, samples = statistics(merged)
+        if i == 2:
+            assert matrix.counts[2, 0] == 10
+            assert np.isclose(matrix.mean[2, 0], scans[0][2][:, 0].mean())
+            mean, rms = mean[1:], rms[1:]
+            assert np.all(matrix.counts[2, 1:] == 40)
+        assert np.allclose(matrix.mean[i, -len(mean):], mean)
+        assert np.allclose(matrix.rms[i, -len(rms):], rms)
+
+
+def test_chirp(tmp_path):
+    delays = np.linspace(-2, 4, 61)
+    n_pix = 5
+    x_axis = np.linspace(400, 800, n_pix)
+    coefficients = [0.002, -0.8] # time zero 0 to 0.8 over the x axis
+    time_zero = np.polyval(coefficients, x_axis)
+    matrix = TAMatrix(delays, n_pix, x_axis)
+    for i, delay in enumerate(delays):
+        ta = np.clip(delay - time_zero, 0, None)
+        matrix.update(i, ta, np.full(n_pix, 0.1), 10)
+    assert matrix.corrected is matrix.corrected # cached
+    assert np.all(matrix.corrected == matrix.mean)
+
+    matrix.set_chirp(coefficients)
+    assert np.allclose(matrix.time_zero, time_zero)
+    corrected = matrix.corrected
+    measured = np.isfinite(corrected)
+    assert np.all(measured[:, 0]) and not np.all(measured[:, -1])
+    expected = np.clip(delays, 0, None)[:, None].repeat(n_pix, axis=1)
+    assert np.allclose(corrected[measured], expected[measured])
+    matrix.update(0, np.zeros(n_pix), np.ones(n_pix), 10)
+    assert matrix.corrected is not corrected # invalidated
+
+    with h5py.File(tmp_path / 'matrix.h5', 'w') as file:
+        matrix.save(file.create_group('ta'))
+    with h5py.File(tmp_path / 'matrix.h5', 'r') as file:
+        assert np.all(file['ta/mean'][:] == matrix.mean)
+        assert np.all(file['ta'].attrs['chirp'] == coefficients)
+
+
+def test_scan_rejection():
+    rng = np.random.default_rng(22)
+    delays = np.arange(8)
+    n_pix = 10
+    truth = rng.normal(0, 1, (len(delays), n_pix))
+    accumulator = ScanAccumulator(delays, n_pix, n_sigma=3, min_scans=3)
+    accepted = []
+    for scan in range(12):
+        data = truth + rng.normal(0, 0.1, (20,) + truth.shape)
+        if scan in [4, 9]:
+            data += 0.5 # e.g. laser drift during the scan
+        for i in range(len(delays)):
+            accumulator.update(i, *statistics(data[:, i]))
+        accumulator.end_scan()
+        if scan not in [4, 9]:
+            accepted.append(data)
+    assert accumulator.rejected == [4, 9]
+    assert np.isnan(accumulator.records[0].deviation) # too few scans
+    assert all(record.deviation < 3 for record in accumulator.records
+               if not record.rejected and record.scan >= 3)
+    assert accumulator.scans == accumulator.accepted == 10
+    assert np.all(accumulator.n_scans == 10)
+    merged = np.concatenate(accepted)
+    assert np.allclose(accumulator.mean, merged.mean(axis=0))
+    assert np.allclose(accumulator.rms, merged.std(axis=0, ddof=1))
+    assert np.all(accumulator.counts == 200)
+
+    # without rejection deviating scans are only flagged
+    flagging = ScanAccumulator(delays, n_pix, min_scans=2, reject=False)
+    for offset in [0, 0, 0, 1]:
+        for i in range(len(delays)):
+            flagging.update(i, *statistics(
+                truth[i] + offset + rng.normal(0, 0.1, (20, n_pix))))
+        flagging.end_scan()
+    assert flagging.records[-1].deviation > 3
+    assert flagging.scans == 4
+
+
+def test_homogeneous_scans():
+    """Scans which only differ by noise are never rejected"""
+    delays = np.arange(8)
+    n_pix = 10
+    for seed in range(10):
+        rng = np.random.default_rng(seed)
+        truth = rng.normal(0, 1, (len(delays), n_pix))
+        accumulator = ScanAccumulator(delays, n_pix)
+        for scan in range(20):
+            data = truth + rng.normal(0, 0.1, (5,) + truth.shape)
+            for i in range(len(delays)):
+                accumulator.update(i, *statistics(data[:, i]))
+            accumulator.end_scan()
+        assert accumulator.rejected == []
+        assert accumulator.scans == 20
+        assert np.isnan(accumulator.records[4].deviation)
+        assert max(record.deviation for record in accumulator.records[5:]) \
+            < 2
+
+
+if __name__ == '__main__':
+    import tempfile, pathlib
+    test_update()
+    test_scan_rejection()
+    test_homogeneous_scans()
+    with tempfile.TemporaryDirectory() as directory:
+        test_chirp(pathlib.Path(directory))
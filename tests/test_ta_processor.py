@@ -1,6 +1,6 @@
 import numpy as np
 from pymodaq_plugins_transient_absorption.ta_processor import TAProcessor, \
-    StatisticsCondition, TACondition
+    StatisticsCondition, TACondition, WhitelightReference, WhitelightChecker
 from pymodaq_plugins_transient_absorption.averager import Averager
 from dataclasses import asdict
 
@@ -152,6 +152,23 @@ def test_dark_fail_then_pass():
     assert fail_count == 0
 
 
+def test_dark_subtraction():
+    ta_processor, n_pix = test_dark_pass()
+    assert ta_processor.dark_template.shape == (2, n_pix)
+    assert np.all(ta_processor.dark_template[0] == 1.5)
+    assert np.all(ta_processor.dark_template[1] == 3.5)
+    raw_data = make_data(n_pix * 2 * 10, n_pix, signal=100, reference=110)
+    items = ta_processor.subtrackt_dark(raw_data)
+    assert items.shape == (5, 4, n_pix)
+    assert np.all(items[:, 0] == 99.5)
+    assert np.all(items[:, 1] == 109.5)
+    assert np.all(items[:, 2] == 100.5)
+    assert np.all(items[:, 3] == 110.5)
+    buffer = ta_processor._dark_subtracted
+    ta_processor.subtrackt_dark(raw_data)
+    assert ta_processor._dark_subtracted is buffer
+
+
 def test_white_pass():
     ta_processor, n_pix = test_dark_pass()
     global success_count
@@ -308,13 +325,150 @@ def test_rejection():
     assert len(dte) == 4
 
 
+def test_ta_block():
+    ta_processor, n_pix = test_white_pass()
+    global success_count
+    success_count = 0
+    ta_processor.ta_averager = \
+        Averager(0, n_pix, n_pix, min_samples=3, limit_diff_rms=1e6,
+                 limit_diff_mean=1e6)
+    rejected = [1, 4]
+    ta_data = np.concatenate(
+        [make_data(n_pix * 4, n_pix, signal=100,
+                   reference=210 if i in rejected else 110, ta=30 + i % 3)
+         for i in range(10)])
+    ta_processor.data_processing_mode = TAProcessor.TA
+    dte, store = ta_processor.process_data(ta_data)
+    assert store
+    assert success_count == 1
+    # success with the sixth accepted item, items 8 and 9 are ignored
+    assert ta_processor.ta_averager.samples == 3
+    assert ta_processor.ta_whitelight_averager.samples == 2 * 8
+    current = dte.get_data_from_name('current')[0]
+    assert abs(current[0] - ta_processor.ta_averager.mean[0]) < 1
+
+
+def test_ta_budget():
+    ta_processor, n_pix = test_white_pass()
+    assert ta_processor.max_ta == 10
+    accepted = make_data(n_pix * 4, n_pix, signal=100, reference=110, ta=30)
+    rejected = make_data(n_pix * 4, n_pix, signal=100, reference=210, ta=30)
+
+    # noise free TA, converges once there are two samples
+    ta_processor.max_ta_rms = 1e-3
+    ta_processor.data_processing_mode = TAProcessor.TA
+    results = [ta_processor.process_data(accepted)[1] for _ in range(3)]
+    assert results == [False, True, False] # idle after success
+    assert ta_processor.ta_converged
+    assert ta_processor.ta_blocks == 2
+
+    # budget of blocks
+    ta_processor.clear_accumulation()
+    assert not ta_processor.ta_converged
+    ta_processor.max_ta_rms = 0
+    ta_processor.max_ta = 3
+    ta_processor.data_processing_mode = TAProcessor.TA
+    for i in range(3):
+        dte, store = ta_processor.process_data(accepted)
+        assert store == (i == 2)
+    assert not ta_processor.ta_converged
+    assert ta_processor.ta_averager.samples == 3
+
+    # budget spent without any TA
+    ta_processor.clear_accumulation()
+    ta_processor.data_processing_mode = TAProcessor.TA
+    fails = fail_count
+    for i in range(3):
+        dte, store = ta_processor.process_data(rejected)
+        assert not store
+    assert ta_processor.data_processing_mode == TAProcessor.IDLE
+    assert fail_count == fails + 1
+
+
+def test_whitelight_checker():
+    n_pix = 10
+    rng = np.random.default_rng(3)
+    references = [WhitelightReference(rng.normal(100, 1, 2), np.full(2, 1.),
+                                      2, 1),
+                  WhitelightReference(rng.normal(100, 1, 5), np.full(5, 2.),
+                                      4, 1)]
+    checker = WhitelightChecker(references)
+    assert checker.pixels.shape == (2, 5)
+    whitelights = rng.normal(100, 2, (50, 2, n_pix))
+    accepted = checker.check(whitelights)
+    expected = np.all([np.all(ref.check(whitelights), axis=1)
+                       for ref in references], axis=0)
+    assert np.all(accepted == expected)
+    assert checker.checked == 50
+    for i,ref in enumerate(references):
+        assert checker.rejected[i] \
+            == 50 - np.count_nonzero(np.all(ref.check(whitelights), axis=1))
+
+
+def test_parallel_whitelight():
+    n_pix = 40
+    ranges = [[2 + 4 * i, 5 + 4 * i] for i in range(8)]
+    ta_condition = \
+        TACondition(limit_diff_rms_dark=1, limit_diff_mean_dark=1, min_dark=2,
+                    max_dark_attempts=30, limit_diff_rms_white=0.2,
+                    limit_diff_mean_white=0.2, min_white=20,
+                    max_white_attempts=10, limit_diff_ta=3)
+    rng = np.random.default_rng(7)
+    blocks = [rng.normal(100, 5, n_pix * 4 * 25) for _ in range(8)]
+    processors = []
+    for threads in [0, 4, 0]:
+        ta_processor = TAProcessor()
+        ta_processor.set_up(n_pix, ta_condition, ranges, False,
+                            statistics_threads=threads)
+        ta_processor.process_data(make_data(n_pix * 4, n_pix))
+        ta_processor.process_data(make_data(n_pix * 4, n_pix))
+        ta_processor.data_processing_mode = TAProcessor.WHITELIGHT
+        for i,av in enumerate(ta_processor.whitelight_averagers[:-1]):
+            av.min_samples = 7 + 3 * i # checks at different items
+        processors.append(ta_processor)
+    assert processors[1].thread_pool is not None
+
+    def item_by_item(ta_processor, raw_data):
+        # reference: feed item after item
+        result = Averager.CONTINUE
+        for item in ta_processor.subtrackt_dark(raw_data):
+            result = Averager.SUCCESS
+            for av in ta_processor.whitelight_averagers[:-1]:
+                result = max(result, av.take_data(item.ravel()))
+            ta_processor.whitelight_averagers[-1].take_data(item.ravel())
+            if result != Averager.CONTINUE:
+                break
+        return result
+
+    for raw_data in blocks:
+        results = [ta_processor.process_whitelight(raw_data)[0]
+                   for ta_processor in processors[:2]]
+        results.append(item_by_item(processors[2], raw_data))
+        assert results[0] == results[1] == results[2]
+        for avs in zip(*[ta_processor.whitelight_averagers
+                         for ta_processor in processors]):
+            assert avs[0].samples == avs[1].samples == avs[2].samples
+            assert avs[0].attempts == avs[1].attempts == avs[2].attempts
+            assert np.allclose(avs[0].sum_values, avs[1].sum_values)
+            assert np.allclose(avs[0].sum_values, avs[2].sum_values)
+        if results[0] != Averager.CONTINUE:
+            break
+    processors[1].close()
+    assert processors[1].thread_pool is None
+
+
 if __name__ == '__main__':
     test_set_up()
     test_dark_pass()
     test_dark_fail()
     test_dark_fail_then_pass()
+    test_dark_subtraction()
     test_white_pass()
     test_white_fail()
     test_white_fail_then_pass()
     test_accumulation()
     test_rejection()
+    test_ta_block()
+    test_ta_budget()
+    test_whitelight_checker()
+    test_parallel_whitelight()
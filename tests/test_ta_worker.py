@@ -0,0 +1,61 @@
+import time
+import numpy as np
+from PyQt5.QtCore import QCoreApplication
+from pymodaq_plugins_transient_absorption.ta_worker import TAProcessorWorker
+from pymodaq_plugins_transient_absorption.ta_processor import TAProcessor, \
+    TACondition
+from test_ta_processor import make_data
+
+
+def test_worker():
+    app = QCoreApplication.instance() or QCoreApplication([])
+    worker = TAProcessorWorker(n_slots=2)
+    events = []
+    results = []
+    worker.acquisition_done.connect(lambda: events.append('done'))
+    worker.acquisition_failed.connect(lambda: events.append('failed'))
+    worker.data_ready.connect(lambda dte, store: results.append((dte, store)))
+    try:
+        n_pix = 10
+        ta_condition = \
+            TACondition(limit_diff_rms_dark=1, limit_diff_mean_dark=1,
+                        min_dark=40, max_dark_attempts=30,
+                        limit_diff_rms_white=1, limit_diff_mean_white=1,
+                        min_white=20, max_white_attempts=10, limit_diff_ta=3)
+        worker.set_up(n_pix, ta_condition, [[2, 4], [6, 8]], False)
+        assert worker.data_processing_mode == TAProcessor.DARK
+        dark_data = make_data(n_pix * 2 * 40, n_pix).astype(np.uint16)
+        for _ in range(2):
+            assert worker.process_data(dark_data)
+        assert worker.wait_idle(timeout=60)
+        app.processEvents() # signals are queued from the listener thread
+        assert events == ['done']
+        assert [store for dte, store in results] == [False, True]
+        assert results[-1][0].name == 'dark'
+        assert worker.data_processing_mode == TAProcessor.IDLE
+
+        worker.reset()
+        for _ in range(2):
+            assert worker.process_data(dark_data)
+        # set while the dark blocks are processed, not overwritten by them
+        worker.data_processing_mode = TAProcessor.WHITELIGHT
+        assert worker.wait_idle(timeout=60)
+        assert worker.data_processing_mode == TAProcessor.WHITELIGHT
+    finally:
+        worker.close()
+
+
+def test_dead_worker():
+    app = QCoreApplication.instance() or QCoreApplication([])
+    worker = TAProcessorWorker(n_slots=1)
+    errors = []
+    worker.error.connect(errors.append)
+    worker.set_up(10, TACondition(1, 1, 40, 30, 1, 1, 20, 10, 3), [], False)
+    worker.make_buffers(800, np.uint16)
+    worker._process.kill()
+    assert worker.process_data(np.zeros(800, dtype=np.uint16), timeout=5)
+    start = time.perf_counter()
+    worker.close() # doesn't wait for the lost block
+    assert time.perf_counter() - start < 5
+    app.processEvents()
+    assert len(errors) == 1 and 'exited' in errors[0]
@@ -0,0 +1,88 @@
+import h5py
+import numpy as np
+from pymodaq_plugins_transient_absorption.ta_writer import TAWriter
+from pymodaq_plugins_transient_absorption.delay_scan import DelayScan
+from test_delay_scan import prepare
+
+
+def test_write(tmp_path):
+    path = tmp_path / 'scan.h5'
+    n_pix = 10
+    rng = np.random.default_rng(8)
+    delays = [-1, 0, 0.5, 1, 2]
+    mean = rng.normal(0, 1, (len(delays), n_pix))
+    blocks = rng.integers(0, 1000, (3, 4 * n_pix), dtype=np.uint16)
+    with TAWriter(path, n_pix, np.linspace(400, 800, n_pix),
+                  attributes={'sample': 'test'}) as writer:
+        writer.write_dark(np.full(n_pix, 1.), np.full(n_pix, 2.))
+        writer.write_whitelight(np.full(n_pix, 3.), np.full(n_pix, 4.))
+        buffer = np.empty(n_pix)
+        for i,delay in enumerate(delays):
+            buffer[:] = mean[i] # writer has to copy reused buffers
+            writer.write_ta(delay, buffer, 2 * buffer, samples=100 + i)
+        for block in blocks:
+            writer.write_raw(0.5, block)
+        writer.flush()
+        assert len(writer.file['ta/mean']) == len(delays)
+
+    with h5py.File(path, 'r') as file:
+        assert file.attrs['sample'] == 'test'
+        assert file['pixels'][-1] == 800
+        assert np.all(file['dark/reference'][:] == 2)
+        assert file['whitelight/rms'].shape == (1, n_pix)
+        assert np.all(file['ta/delay'][:] == delays)
+        assert np.all(file['ta/mean'][:] == mean)
+        assert np.all(file['ta/rms'][:] == 2 * mean)
+        assert np.all(file['ta/samples'][:] == 100 + np.arange(len(delays)))
+        assert file['ta/mean'].maxshape == (None, n_pix)
+        raw = file['raw/blocks']
+        assert raw.dtype == np.uint16
+        assert raw.compression == 'lzf'
+        assert np.all(raw[:] == blocks)
+
+
+def test_missing_rms(tmp_path):
+    """Rows stay aligned if rms is only sometimes given"""
+    with TAWriter(tmp_path / 'mixed.h5', 10) as writer:
+        writer.write_ta(0, np.zeros(10), np.ones(10), 5)
+        writer.write_ta(1, np.zeros(10)) # no rms
+    with h5py.File(tmp_path / 'mixed.h5', 'r') as file:
+        assert file['ta/rms'].shape == file['ta/mean'].shape == (2, 10)
+        assert np.all(np.isnan(file['ta/rms'][1]))
+
+
+def test_write_error(tmp_path):
+    writer = TAWriter(tmp_path / 'error.h5', 10)
+    writer.write_ta(0, np.zeros(10))
+    writer.write_ta(1, np.zeros(12)) # row doesn't fit the dataset
+    try:
+        writer.flush()
+        assert False
+    except RuntimeError:
+        pass
+    writer.close()
+
+
+def test_scan(tmp_path):
+    """One row per delay of a scan"""
+    controller, processor = prepare()
+    delays = [-5e-12, 0, 5e-12]
+    with TAWriter(tmp_path / 'points.h5', 40) as writer:
+        points = DelayScan(controller, processor, delays,
+                           max_blocks=2).run(writer.write_point)
+    with h5py.File(tmp_path / 'points.h5', 'r') as file:
+        assert np.all(file['ta/delay'][:] == delays)
+        assert np.all(file['ta/samples'][:]
+                      == [point.samples for point in points])
+        assert np.all(file['ta/mean'][:]
+                      == [point.mean for point in points])
+        assert np.all(file['ta/rms'][:] == [point.rms for point in points])
+
+
+if __name__ == '__main__':
+    import tempfile, pathlib
+    with tempfile.TemporaryDirectory() as directory:
+        test_write(pathlib.Path(directory))
+        test_missing_rms(pathlib.Path(directory))
+        test_write_error(pathlib.Path(directory))
+        test_scan(pathlib.Path(directory))